@@ -1,31 +1,42 @@
 import os
-from sqlalchemy import create_engine
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.utilities import SQLDatabase
-from langchain_community.agent_toolkits import create_sql_agent
-from langchain.agents import AgentType
-from config import LLM_MODEL, GOOGLE_API_KEY
-from db import get_schema_info
-from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-
-
-def init_llm():
-    return ChatGoogleGenerativeAI(
-        model=LLM_MODEL,
-        temperature=0,
-        google_api_key=GOOGLE_API_KEY,
-    )
+from config import AGENT_POOL_SIZE, AGENT_POOL_TTL
+from db import get_schema_info, get_engine_for_path, on_tenant_database_change
+from cache import LRUCache
+from llm_provider import get_llm
+from executor import SQLBudgetExceeded, run_governed, format_result
+
+
+def init_llm(chain_name: str = None):
+    """Devuelve el cliente LLM compartido del proceso (ver llm_provider)."""
+    return get_llm(chain_name)
 
 def init_sql_agent(db_path: str, tenant_name: str, base_name: str):
-    llm = init_llm()
+    # Imports pesados diferidos: solo se pagan al crear el primer agente
+    from langchain_community.utilities import SQLDatabase
+    from langchain_community.agent_toolkits import create_sql_agent, SQLDatabaseToolkit
+    from langchain.agents import AgentType
+
+    llm = init_llm("sql_agent")
     # Carga descripciones semánticas
     info = get_schema_info(tenant_name, base_name)
     # crea agente con custom_table_info
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"No se encontró la base de datos en: {db_path}")
 
-    db = SQLDatabase(
-        engine=create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False}),
+    class GovernedSQLDatabase(SQLDatabase):
+        """La herramienta de consultas del agente lee con límites y devuelve un resultado compacto."""
+
+        def run(self, command, fetch="all", include_columns=False, **kwargs):
+            if not isinstance(command, str) or fetch != "all":
+                return super().run(command, fetch, include_columns, **kwargs)
+            try:
+                return format_result(run_governed(self._engine, command))
+            except SQLBudgetExceeded as e:
+                # Mismo formato que run_no_throw: el agente lee el error y reescribe la consulta
+                return f"Error: {e}"
+
+    db = GovernedSQLDatabase(
+        engine=get_engine_for_path(db_path),
         custom_table_info=info
     )
     toolkit = SQLDatabaseToolkit(db=db, llm=llm)
@@ -36,3 +47,32 @@ def init_sql_agent(db_path: str, tenant_name: str, base_name: str):
         verbose=True,
         handle_parsing_errors=True
     )
+
+# ----------------------------------------
+# Pool de agentes por (tenant, base)
+# ----------------------------------------
+
+# El engine es compartido (ver db.get_engine_for_path), así que descartar un
+# agente no cierra conexiones.
+_agent_pool = LRUCache(maxsize=AGENT_POOL_SIZE, ttl=AGENT_POOL_TTL)
+
+def get_sql_agent(db_path: str, tenant_name: str, base_name: str):
+    """
+    Devuelve el agente SQL de (tenant, base) desde el pool, creándolo si hace falta.
+    Si la base se registró con otro path, el agente cacheado se reconstruye.
+    """
+    key = (tenant_name, base_name)
+    build = lambda: (db_path, init_sql_agent(db_path, tenant_name, base_name))
+    entry = _agent_pool.get_or_create(key, build)
+    if entry[0] != db_path:
+        _agent_pool.invalidate(key)
+        entry = _agent_pool.get_or_create(key, build)
+    return entry[1]
+
+@on_tenant_database_change
+def invalidate_sql_agent(tenant_name: str, base_name: str):
+    """Descarta el agente cacheado cuando cambia el esquema o el registro de la base."""
+    _agent_pool.invalidate((tenant_name, base_name))
+
+def agent_pool_stats() -> dict:
+    return _agent_pool.stats()
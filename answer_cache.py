@@ -0,0 +1,191 @@
+# answer_cache.py
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from typing import NamedTuple, Optional
+
+from config import ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY
+from db import on_tenant_database_change
+
+
+class CachedAnswer(NamedTuple):
+    question: str
+    sql: Optional[str]
+    result: str
+    explanation: str
+    schema_version: str
+    data_version: tuple
+    created_at: float
+
+
+def normalize_question(question: str) -> str:
+    """Minúsculas, sin acentos ni signos de puntuación y con espacios simples."""
+    text = unicodedata.normalize("NFKD", question.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+# Palabras que cambian el sentido aunque la pregunta sea casi igual: negaciones y comparaciones
+_EXACT_WORDS = {
+    "no", "sin", "ni", "nunca", "jamas", "ningun", "ninguna", "ninguno", "excepto", "salvo",
+    "mas", "menos", "mayor", "mayores", "menor", "menores", "antes", "despues", "primer", "primero",
+    "primeros", "ultimo", "ultimos", "not", "without", "never", "except", "more", "less", "fewer",
+    "greater", "before", "after", "first", "last", "top", "bottom",
+}
+_QUOTED = re.compile(r'"([^"]+)"|«([^»]+)»|“([^”]+)”|(?:^|\s)\'([^\']+)\'')
+
+
+def literal_signature(question: str) -> tuple:
+    """
+    Lo que tiene que coincidir exactamente para aceptar una pregunta parecida:
+    números, literales entre comillas, negaciones y comparaciones.
+    """
+    normalized = normalize_question(question)
+    quoted = tuple(normalize_question("".join(groups)) for groups in _QUOTED.findall(question))
+    return (
+        tuple(re.findall(r"\d+", normalized)),
+        quoted,
+        tuple(w for w in normalized.split() if w in _EXACT_WORDS),
+    )
+
+
+# Preguntas que solo tienen sentido con la conversación previa ("¿y en 2013?", "¿y esos clientes?")
+# Solo conectores que abren una continuación y anáforas que no aparecen en preguntas
+# autónomas ("what", "it" o "that" como relativo sí aparecen: "customers that bought")
+_FOLLOW_UP_START = {"y", "e", "pero", "entonces", "ahora", "tambien", "and", "also", "but"}
+_FOLLOW_UP_WORDS = {
+    "eso", "esos", "esas", "ese", "esa", "ello", "mismo", "misma", "mismos", "mismas",
+    "anterior", "anteriores", "previo", "previa", "ahi", "alli",
+    "those", "them", "same", "previous", "above",
+}
+
+
+def is_follow_up(question: str) -> bool:
+    """Heurística: pregunta muy corta, que arranca como continuación o que refiere a algo anterior."""
+    words = normalize_question(question).split()
+    return len(words) <= 2 or words[0] in _FOLLOW_UP_START or any(w in _FOLLOW_UP_WORDS for w in words)
+
+
+def _trigrams(normalized: str) -> frozenset:
+    padded = f"  {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class AnswerIndex:
+    """
+    Respuestas de una base: acceso exacto por pregunta normalizada y un índice
+    invertido de trigramas para encontrar preguntas casi iguales.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()        # normalized -> CachedAnswer
+        self.grams = {}                     # normalized -> trigramas
+        self.signatures = {}                # normalized -> literal_signature de la pregunta
+        self.postings = defaultdict(set)    # trigrama -> {normalized}
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        self.signatures.pop(key, None)
+        for gram in self.grams.pop(key, ()):
+            keys = self.postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    def put(self, key: str, answer: CachedAnswer):
+        self._remove(key)
+        grams = _trigrams(key)
+        self.entries[key] = answer
+        self.grams[key] = grams
+        self.signatures[key] = literal_signature(answer.question)
+        for gram in grams:
+            self.postings[gram].add(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def find(self, key: str, threshold: float, signature: tuple = None):
+        """
+        Devuelve (normalized, answer) exacto o el más similar por encima del umbral.
+        Una pregunta parecida solo se acepta si tiene la misma literal_signature.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return key, self.entries[key]
+
+        grams = _trigrams(key)
+        overlap = Counter()
+        for gram in grams:
+            for candidate in self.postings.get(gram, ()):
+                overlap[candidate] += 1
+
+        best, best_score = None, 0.0
+        for candidate, shared in overlap.items():
+            score = shared / (len(grams) + len(self.grams[candidate]) - shared)
+            if score < threshold or score <= best_score:
+                continue
+            if signature is not None and self.signatures[candidate] != signature:
+                # "… en 2023" y "… en 2024" se parecen pero no son la misma pregunta
+                _stats["rejected_literals"] += 1
+                continue
+            best, best_score = candidate, score
+        if best is None:
+            return None
+        self.entries.move_to_end(best)
+        return best, self.entries[best]
+
+
+_indexes = defaultdict(AnswerIndex)  # (tenant, base) -> AnswerIndex
+_lock = threading.Lock()
+_stats = Counter()
+
+
+def lookup_answer(tenant_name: str, base_name: str, question: str,
+                  schema_version: str, data_version: tuple) -> Optional[CachedAnswer]:
+    """
+    Busca una respuesta para la pregunta. Solo es válida si se generó con la
+    misma versión del esquema y sin cambios en los datos desde entonces.
+    """
+    key = normalize_question(question)
+    with _lock:
+        found = _indexes[(tenant_name, base_name)].find(key, ANSWER_CACHE_SIMILARITY, literal_signature(question))
+        if found is None:
+            _stats["misses"] += 1
+            return None
+        matched, answer = found
+        if answer.schema_version != schema_version or answer.data_version != data_version:
+            _indexes[(tenant_name, base_name)]._remove(matched)
+            _stats["stale"] += 1
+            _stats["misses"] += 1
+            return None
+        _stats["hits_exact" if matched == key else "hits_similar"] += 1
+        return answer
+
+
+def skip_answer(reason: str):
+    """Cuenta las consultas que no usan el cache (p.ej. preguntas que dependen de la conversación)."""
+    with _lock:
+        _stats[f"skipped_{reason}"] += 1
+
+
+def store_answer(tenant_name: str, base_name: str, question: str, sql: Optional[str],
+                 result: str, explanation: str, schema_version: str, data_version: tuple):
+    answer = CachedAnswer(question, sql, result, explanation, schema_version, data_version, time.time())
+    with _lock:
+        _indexes[(tenant_name, base_name)].put(normalize_question(question), answer)
+        _stats["stored"] += 1
+
+
+@on_tenant_database_change
+def invalidate_answers(tenant_name: str, base_name: str):
+    with _lock:
+        _indexes.pop((tenant_name, base_name), None)
+
+
+def answer_cache_stats() -> dict:
+    with _lock:
+        return {"bases": len(_indexes), "entries": sum(len(i.entries) for i in _indexes.values()), **_stats}
@@ -1,36 +1,68 @@
+import startup  # primero: marca el inicio para el reporte de arranque
 import json
 import os
-from fastapi import FastAPI, HTTPException, Header, Depends
+from fastapi import FastAPI, HTTPException, Header, Depends, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.exc import IntegrityError
 import secrets
 
-from db import init_admin_db, get_admin_session, get_tenant_db, get_schema_info, set_schema_info
+from config import WARMUP_MODE, RESULT_PAGE_SIZE_MAX, METRICS_TOKEN
+from db import (
+    init_admin_db, get_admin_session, get_schema_info, set_schema_info,
+    get_tenant_engine, notify_tenant_database_change, tenant_engine_stats, schema_cache_stats, enable_wal,
+)
 from models import User, Tenant, TenantDatabase
-from memory import add_message, get_context_window
-from agent import init_sql_agent
-from chains.clarificador import clarificador_chain
-from chains.explicador import explicador_chain
-from chains.clasificador import clasificador_chain
-from chains.reformulador import reformulador_chain
-from chains.corrector import corrector_chain
+from memory import flush_messages, memory_cache_stats
+from identity import (
+    CachedUser, get_user_by_api_key, invalidate_user, invalidate_tenant, invalidate_identity,
+    identity_cache_stats,
+)
+from agent import agent_pool_stats
+from answer_cache import answer_cache_stats
+from llm_cache import llm_cache_stats
+from llm_provider import LLMBusyError, llm_provider_stats
+from executor import (
+    SQLBudgetExceeded, get_registered_query, fetch_page, error_message, budget_stats, check_sql_budget,
+)
+from materialize import materialize_stats
+from metrics import render_metrics
+from retention import run_retention
+from schema_index import schema_index_stats
+from export import EXPORT_FORMATS, ExportUnavailable, iter_export
+from pipeline import (
+    run_query, run_feedback, stream_query, resolve_sql_mode, repair_stats, speculation_stats,
+)
+
+startup.mark("app_imported")
 
 # Clave para proteger endpoints administrativos
 ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
 
-app = FastAPI(on_startup=[init_admin_db])
+def warmup_chains():
+    if WARMUP_MODE == "startup":
+        startup.warmup()
+    elif WARMUP_MODE == "background":
+        startup.warmup_in_background()
+    startup.mark("ready")
+
+app = FastAPI(on_startup=[init_admin_db, warmup_chains], on_shutdown=[flush_messages])
 #iniciar server con: uvicorn app:app --reload --host 0.0.0.0 --port 8000
 
+@app.exception_handler(LLMBusyError)
+async def llm_busy_handler(request: Request, exc: LLMBusyError):
+    # Backpressure: el cliente debe reintentar más tarde
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": "5"})
+
 # ----------------------------------------
 # Dependencias de autenticación
 # ----------------------------------------
 
-def get_current_user(x_api_key: str = Header(...)):
+async def get_current_user(x_api_key: str = Header(...)):
     """
     Valida el header X-API-KEY y devuelve el usuario.
     """
-    db = get_admin_session()
-    user = db.query(User).filter_by(api_key=x_api_key).first()
-    db.close()
+    user = await get_user_by_api_key(x_api_key)
     if not user:
         raise HTTPException(status_code=401, detail="API key inválida")
     return user
@@ -44,6 +76,17 @@ def get_admin(x_admin_key: str = Header(...)):
         raise HTTPException(status_code=403, detail="Admin API key inválida")
     return True
 
+def get_metrics_reader(authorization: str = Header(None), x_admin_key: str = Header(None)):
+    """
+    /metrics expone los contadores de /admin/stats y etiquetas por tenant: se lee con
+    Authorization: Bearer METRICS_TOKEN (scraper de Prometheus) o con X-ADMIN-KEY.
+    """
+    if METRICS_TOKEN and authorization and secrets.compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+        return True
+    if ADMIN_API_KEY and x_admin_key and secrets.compare_digest(x_admin_key, ADMIN_API_KEY):
+        return True
+    raise HTTPException(status_code=403, detail="Token de métricas inválido")
+
 # ----------------------------------------
 # Endpoints de administración
 # ----------------------------------------
@@ -69,6 +112,7 @@ def register_tenant(name: str):
     db.commit()
     db.refresh(tenant)
     db.close()
+    invalidate_tenant(tenant.name)
     return {"tenant_id": tenant.id, "name": tenant.name}
 
 @app.post("/admin/register_database", dependencies=[Depends(get_admin)])
@@ -95,7 +139,10 @@ def register_database(tenant_id: int, base_name: str, db_path: str, schema_info:
         db.close()
         raise HTTPException(400, "Esta base ya está registrada para el tenant")
     db.refresh(td)
+    tenant_name = tenant.name
     db.close()
+    enable_wal(db_path)
+    notify_tenant_database_change(tenant_name, base_name)
     return {"database_id": td.id, "base_name": td.base_name}
 
 @app.post("/schema/{tenant_name}/{base_name}", dependencies=[Depends(get_admin)])
@@ -198,120 +245,218 @@ def register_user(tenant_id: int, username: str):
     db.close()
     return {"user_id": user.id, "username": user.username, "api_key": user.api_key}
 
+@app.post("/admin/rotate_key", dependencies=[Depends(get_admin)])
+def rotate_key(username: str):
+    """
+    Revoca la api_key del usuario y le genera una nueva. La anterior deja de valer
+    de inmediato en todos los workers (se invalida en el cache de identidad).
+    """
+    db = get_admin_session()
+    user = db.query(User).filter_by(username=username).first()
+    if not user:
+        db.close()
+        raise HTTPException(404, "Usuario no encontrado")
+    old_key = user.api_key
+    user.api_key = secrets.token_urlsafe(32)
+    db.commit()
+    db.refresh(user)
+    db.close()
+    invalidate_user(old_key)
+    return {"user_id": user.id, "username": user.username, "api_key": user.api_key}
+
+@app.post("/admin/cache/invalidate", dependencies=[Depends(get_admin)])
+def invalidate_cache(tenant_name: str = None, base_name: str = None):
+    """
+    Descarta lo cacheado del admin DB tras cambios hechos por fuera de la API.
+    Con tenant y base invalida esa base; solo con tenant, el tenant y sus usuarios;
+    sin parámetros, todo el cache de identidad.
+    """
+    if base_name and not tenant_name:
+        raise HTTPException(400, "base_name requiere tenant_name")
+    if base_name:
+        notify_tenant_database_change(tenant_name, base_name)
+    elif tenant_name:
+        invalidate_tenant(tenant_name)
+    else:
+        invalidate_identity()
+    return {"status": "ok"}
+
+def collect_stats() -> dict:
+    return {
+        "identity": identity_cache_stats(),
+        "agent_pool": agent_pool_stats(),
+        "tenant_engines": tenant_engine_stats(),
+        "schemas": schema_cache_stats(),
+        "schema_index": schema_index_stats(),
+        "memory": memory_cache_stats(),
+        "answers": answer_cache_stats(),
+        "llm": llm_cache_stats(),
+        "llm_provider": llm_provider_stats(),
+        "sql_repair": repair_stats(),
+        "sql_budget": budget_stats(),
+        "speculation": speculation_stats(),
+        "materialized": materialize_stats(),
+    }
+
+@app.post("/admin/retention", dependencies=[Depends(get_admin)])
+async def retention(tenant_name: str = None, dry_run: bool = False):
+    """
+    Aplica la política de retención (RETENTION_POLICIES): archiva los mensajes
+    viejos por tenant y mes y compacta el admin DB. Con dry_run solo cuenta.
+    """
+    return await run_in_threadpool(run_retention, tenant_name, dry_run)
+
+@app.get("/admin/stats", dependencies=[Depends(get_admin)])
+def stats():
+    """
+    Devuelve contadores de los caches internos (hits/misses, tamaño, desalojos).
+    """
+    return collect_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(get_metrics_reader)])
+def prometheus_metrics():
+    """
+    Métricas en formato Prometheus: latencia por etapa, llamadas/tokens por chain,
+    tiempo y filas de SQL por tenant y los contadores de /admin/stats.
+    """
+    return PlainTextResponse(render_metrics(collect_stats()), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/startup", dependencies=[Depends(get_admin)])
+def startup_info():
+    """
+    Reporte de arranque del worker: costo de imports, inicialización y precalentado.
+    """
+    return startup.startup_report()
+
 # ----------------------------------------
 # Endpoints de usuario
 # ----------------------------------------
 
 @app.post("/query/{tenant_name}/{base_name}")
-def query_sql(
+async def query_sql(
     tenant_name: str,
     base_name: str,
     payload: dict,
-    user: User = Depends(get_current_user)
+    user: CachedUser = Depends(get_current_user)
 ):
     """
     Procesa una consulta SQL en lenguaje natural usando contexto persistente.
     """
-    # 1) Obtener pregunta del usuario
     pregunta = payload.get("question")
     if not pregunta:
         raise HTTPException(status_code=400, detail="Falta campo 'question'")
 
-    # 2) Guardar pregunta original en la conversación
-    add_message(tenant_name, user.id, "user", pregunta)
-
-    # 3) Cargar contexto de conversación previa
-    context = get_context_window(tenant_name, user.id)
-    context_text = "\n".join(f"{r}: {c}" for r, c in context) if context else ""
-
-    # 4) Cargar esquema semántico de la base
-    schema_dict = get_schema_info(tenant_name, base_name)
-    schema_text = str(schema_dict) if schema_dict else ""
-
-    # 5) Proceso de clarificación
-    clar = clarificador_chain.run({
-        "schema": schema_text,
-        "contexto": context_text,
-        "pregunta": pregunta
-    }).strip()
-
-    add_message(tenant_name, user.id, "assistant_clarification", clar)
-
-    if clar != "NO_CLARIFICATION_NEEDED":
-        return {
-            "status": "clarification",
-            "questions": clar.split("\n")
-        }
-
-    # 6) Ejecutar la consulta con el agente SQL
     try:
-        SessionDB = get_tenant_db(tenant_name, base_name)
-        db_path = SessionDB().bind.url.database
-
-        # 🧠 Armar input final para el agente SQL
-        input_text = f"""Cuando tengas la respuesta final, respondé con:
-
-Final Answer: [tu respuesta]
-
-No agregues ningún otro texto fuera de ese formato.
+        mode = resolve_sql_mode(tenant_name, payload.get("mode"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        Contexto previo:
-{context_text}
+    return await run_query(tenant_name, base_name, user.id, pregunta, mode)
 
-Esquema de la base:
-{schema_text}
+@app.post("/query/{tenant_name}/{base_name}/stream")
+async def query_sql_stream(
+    tenant_name: str,
+    base_name: str,
+    payload: dict,
+    user: CachedUser = Depends(get_current_user)
+):
+    """
+    Igual que /query pero responde con server-sent events a medida que avanza:
+    clarification, agent_action, agent_observation, result, explanation_token, done (o error).
+    """
+    pregunta = payload.get("question")
+    if not pregunta:
+        raise HTTPException(status_code=400, detail="Falta campo 'question'")
 
-Pregunta del usuario:
-{pregunta}
+    try:
+        mode = resolve_sql_mode(tenant_name, payload.get("mode"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-Aclaraciones:
-{clar}
-"""
+    return StreamingResponse(
+        stream_query(tenant_name, base_name, user.id, pregunta, mode),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        # 🎯 Ejecutar agente
-        sql_agent = init_sql_agent(
-            db_path=db_path,
-            tenant_name=tenant_name,
-            base_name=base_name
+@app.get("/results/{query_id}")
+async def query_results(
+    query_id: str,
+    page: int = 1,
+    page_size: int = 100,
+    user: CachedUser = Depends(get_current_user)
+):
+    """
+    Descarga paginada del resultado completo de una consulta ya ejecutada por /query.
+    """
+    registered = await run_in_threadpool(get_registered_query, query_id)
+    if registered is None or registered.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Consulta no encontrada o expirada")
+    if page < 1 or not 1 <= page_size <= RESULT_PAGE_SIZE_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"page debe ser >= 1 y page_size entre 1 y {RESULT_PAGE_SIZE_MAX}"
         )
-        resultado = sql_agent.run({"input": input_text})
 
+    engine = await run_in_threadpool(get_tenant_engine, registered.tenant_name, registered.base_name)
+    try:
+        columns, rows = await run_in_threadpool(
+            fetch_page, engine, registered.sql, (page - 1) * page_size, page_size + 1, registered.tenant_name
+        )
     except Exception as e:
-            error_msg = str(e)
-
-            # Llamás a la chain de corrección
-            fixed_query = corrector_chain.run({
-                "schema": schema_text,
-                "query": input_text,
-                "error": error_msg,
-            })
-            resultado = sql_agent.run(fixed_query.strip())
-
-    # 7) Generar explicación del resultado
-    explic = explicador_chain.run({
-        "contexto": context_text,
-        "pregunta": pregunta,
-        "schema": schema_text,
-        "resultado": resultado
-
-    }).strip()
-
-    # 8) Guardar resultado y explicación en la conversación
-    add_message(tenant_name, user.id, "assistant_query_result", resultado)
-    add_message(tenant_name, user.id, "assistant_explanation", explic)
+        raise HTTPException(status_code=400, detail=error_message(e))
 
     return {
-        "status": "success",
-        "result": resultado,
-        "explicacion": explic
+        "query_id": query_id,
+        "page": page,
+        "page_size": page_size,
+        "columns": columns,
+        "rows": rows[:page_size],
+        "has_more": len(rows) > page_size,
     }
 
+@app.get("/export/{query_id}")
+async def export_results(
+    query_id: str,
+    format: str = "csv",
+    user: CachedUser = Depends(get_current_user)
+):
+    """
+    Vuelve a ejecutar la SQL final de una consulta y transmite todas las filas
+    en csv, arrow (IPC stream) o parquet, en lotes y sin pasar por el LLM.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato inválido, opciones: {', '.join(EXPORT_FORMATS)}"
+        )
+    registered = await run_in_threadpool(get_registered_query, query_id)
+    if registered is None or registered.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Consulta no encontrada o expirada")
+
+    engine = await run_in_threadpool(get_tenant_engine, registered.tenant_name, registered.base_name)
+    try:
+        # El límite de filas a recorrer se chequea antes de empezar a responder
+        await run_in_threadpool(check_sql_budget, engine, registered.sql, registered.tenant_name)
+        body = iter_export(engine, registered.sql, format, tenant_name=registered.tenant_name)
+    except SQLBudgetExceeded as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExportUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+
+    extension = {"csv": "csv", "arrow": "arrows", "parquet": "parquet"}[format]
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{query_id}.{extension}"'},
+    )
+
 @app.post("/feedback/{tenant_name}/{base_name}")
-def feedback(
+async def feedback(
     tenant_name: str,
     base_name: str,
     payload: dict,
-    user: User = Depends(get_current_user)
+    user: CachedUser = Depends(get_current_user)
 ):
     """
     Recibe feedback del usuario y, si no fue útil, reformula la consulta.
@@ -320,15 +465,4 @@ def feedback(
     if not fb:
         raise HTTPException(400, "Falta campo 'feedback'")
 
-    utilidad = clasificador_chain.run({"feedback": fb}).strip().lower()
-    add_message(tenant_name, user.id, "user_feedback", fb)
-
-    if utilidad == "útil":
-        return {"status": "ok", "message": "¡Genial que haya servido!"}
-
-    context = get_context_window(tenant_name, user.id)
-    hist_str = "\n".join(f"{r}: {c}" for r, c in context)
-    nueva = reformulador_chain.run({"historial": hist_str, "nueva_aclaracion": fb}).strip()
-
-    add_message(tenant_name, user.id, "assistant_reformulated_query", nueva)
-    return {"status": "reformulate", "new_query": nueva}
+    return await run_feedback(tenant_name, user.id, fb)
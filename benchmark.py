@@ -0,0 +1,302 @@
+# benchmark.py
+"""
+Benchmark offline del servicio: reemplaza el LLM por un modelo falso con
+respuestas guionadas y latencia configurable, siembra un admin DB temporal con
+tenants, usuarios y data/chinook.db, y dispara /query y /feedback con usuarios
+concurrentes a través de la app ASGI (sin red).
+
+    python benchmark.py --users 20 --requests 10 --latency 0.05 --mode fast
+
+Reporta p50/p95/p99, requests por segundo, consultas al admin DB por request y
+crecimiento de memoria (tracemalloc, que agrega algo de overhead a todas las
+mediciones). El reporte también se guarda en bench_output.txt.
+Requiere httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Preguntas guionadas sobre chinook y la SQL que "genera" el modelo falso
+SCRIPT = [
+    ("¿Cuántos artistas hay?", "SELECT COUNT(*) AS artistas FROM artists"),
+    (
+        "¿Cuáles son los 10 géneros con más canciones?",
+        "SELECT g.Name, COUNT(*) AS canciones FROM tracks t JOIN genres g ON t.GenreId = g.GenreId "
+        "GROUP BY g.Name ORDER BY canciones DESC LIMIT 10",
+    ),
+    (
+        "¿Cuánto facturó cada país?",
+        "SELECT BillingCountry, ROUND(SUM(Total), 2) AS total FROM invoices "
+        "GROUP BY BillingCountry ORDER BY total DESC",
+    ),
+    (
+        "¿Qué clientes gastaron más?",
+        "SELECT c.FirstName, c.LastName, ROUND(SUM(i.Total), 2) AS total FROM customers c "
+        "JOIN invoices i ON i.CustomerId = c.CustomerId GROUP BY c.CustomerId ORDER BY total DESC LIMIT 5",
+    ),
+    ("Listá todas las canciones", "SELECT Name, Composer, Milliseconds FROM tracks"),
+]
+
+FEEDBACKS = ["¡Perfecto, gracias!", "No me sirvió, no entiendo qué significan esos números"]
+
+
+def _configure_env(workdir: str, args):
+    """Config se lee al importar: el entorno tiene que quedar listo antes de importar la app."""
+    os.environ.update({
+        "ADMIN_DB_URL": f"sqlite:///{os.path.join(workdir, 'tenants.db')}",
+        "GOOGLE_API_KEY": "benchmark",
+        "WARMUP_MODE": "off",
+        "LLM_CACHE_ENABLED": "false",
+        "ANSWER_CACHE_ENABLED": "true" if args.answer_cache else "false",
+        "SQL_MODE": args.mode,
+        "METRICS_TRACE_SAMPLE": "0",
+        "ADMIN_CACHE_SYNC_PATH": "",
+    })
+
+
+def build_fake_llm(chain_name: str, latency: float):
+    """Modelo de chat determinístico: responde según la chain y la pregunta del prompt."""
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from metrics import LLMMetricsHandler
+    from pipeline import NO_CLARIFICATION
+
+    class ScriptedChatModel(BaseChatModel):
+        chain: str = "default"
+        latency: float = 0.0
+
+        @property
+        def _llm_type(self) -> str:
+            return "scripted"
+
+        def _reply(self, text: str) -> str:
+            sql = next((s for q, s in SCRIPT if q in text), SCRIPT[0][1])
+            if self.chain == "clarificador":
+                return NO_CLARIFICATION
+            if self.chain in ("generador", "corrector"):
+                return sql
+            if self.chain == "sql_agent":
+                if f"Action Input: {sql}" in text:
+                    return "Thought: Ya tengo el resultado.\nFinal Answer: Resultado de la consulta."
+                return f"Thought: Consulto la base.\nAction: sql_db_query\nAction Input: {sql}"
+            if self.chain == "clasificador":
+                return "no útil" if "No me sirvió" in text else "útil"
+            if self.chain == "reformulador":
+                return "Reformulación: mostrar el resultado con una explicación más simple."
+            return "Estos son los datos que pediste. ¿Te resultó útil esta explicación?"
+
+        def _result(self, messages) -> ChatResult:
+            text = "\n".join(str(m.content) for m in messages)
+            reply = self._reply(text)
+            message = AIMessage(content=reply, usage_metadata={
+                "input_tokens": len(text) // 4,
+                "output_tokens": len(reply) // 4,
+                "total_tokens": (len(text) + len(reply)) // 4,
+            })
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            return self._result(messages)
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(self.latency)
+            return self._result(messages)
+
+    return ScriptedChatModel(
+        chain=chain_name or "default", latency=latency, callbacks=[LLMMetricsHandler(chain_name)]
+    )
+
+
+def seed(workdir: str, tenants: int, users: int):
+    """Crea tenants con la base chinook (copiada al directorio temporal) y sus usuarios."""
+    from db import get_admin_session, init_admin_db
+    from models import Tenant, TenantDatabase, User
+
+    init_admin_db()
+    db_path = os.path.join(workdir, "chinook.db")
+    shutil.copy(os.path.join(DATA_DIR, "chinook.db"), db_path)
+    with open(os.path.join(DATA_DIR, "chinook_schema.json"), encoding="utf-8") as f:
+        schema_info = json.load(f)
+    schema_info = schema_info.get("schema", schema_info)
+
+    db = get_admin_session()
+    accounts = []
+    for t in range(tenants):
+        tenant = Tenant(name=f"bench_{t}")
+        db.add(tenant)
+        db.flush()
+        db.add(TenantDatabase(tenant_id=tenant.id, base_name="chinook", db_path=db_path, schema_info=schema_info))
+        for u in range(users):
+            if u % tenants != t:
+                continue
+            api_key = secrets.token_urlsafe(16)
+            db.add(User(username=f"user_{u}", api_key=api_key, tenant_id=tenant.id))
+            accounts.append((tenant.name, api_key))
+    db.commit()
+    db.close()
+    return accounts
+
+
+class AdminQueryCounter:
+    """Cuenta las sentencias que llegan al admin DB (engine sync y async)."""
+
+    def __init__(self, admin_path: str):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        self.admin_path = os.path.abspath(admin_path)
+        self.count = 0
+        event.listen(Engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, *args):
+        database = conn.engine.url.database
+        if database and os.path.abspath(database) == self.admin_path:
+            self.count += 1
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    # Nearest-rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def run_user(client, tenant: str, api_key: str, args, rng, latencies, errors):
+    headers = {"X-API-KEY": api_key}
+    for _ in range(args.requests):
+        question = rng.choice(SCRIPT)[0]
+        started = time.perf_counter()
+        response = await client.post(f"/query/{tenant}/chinook", json={"question": question}, headers=headers)
+        latencies["query"].append(time.perf_counter() - started)
+        if response.status_code != 200:
+            errors["query"] += 1
+
+        if rng.random() < args.feedback_ratio:
+            started = time.perf_counter()
+            response = await client.post(
+                f"/feedback/{tenant}/chinook", json={"feedback": rng.choice(FEEDBACKS)}, headers=headers
+            )
+            latencies["feedback"].append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors["feedback"] += 1
+
+
+async def run_benchmark(args, workdir: str) -> str:
+    try:
+        import httpx
+    except ImportError:
+        sys.exit("El benchmark requiere httpx: pip install httpx")
+
+    _configure_env(workdir, args)
+    import agent
+    import llm_provider
+
+    fake_llms = {}
+
+    def fake_get_llm(chain_name: str = None):
+        if chain_name not in fake_llms:
+            fake_llms[chain_name] = build_fake_llm(chain_name, args.latency)
+        return fake_llms[chain_name]
+
+    llm_provider.get_llm = fake_get_llm
+    agent.init_llm = fake_get_llm
+
+    from app import app
+    from memory import flush_messages
+
+    accounts = seed(workdir, args.tenants, args.users)
+    counter = AdminQueryCounter(os.path.join(workdir, "tenants.db"))
+    rng = random.Random(args.seed)
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        # Calentamiento: construye chains, agentes, engines y caches antes de medir
+        warm_args = argparse.Namespace(requests=1, feedback_ratio=1.0)
+        first_account = dict(reversed(accounts))
+        await asyncio.gather(*(
+            run_user(client, tenant, key, warm_args, rng, defaultdict(list), defaultdict(int))
+            for tenant, key in first_account.items()
+        ))
+        flush_messages()
+
+        latencies, errors = defaultdict(list), defaultdict(int)
+        counter.count = 0
+        tracemalloc.start()
+        mem_before, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(client, tenant, key, args, random.Random(rng.random()), latencies, errors)
+            for tenant, key in accounts
+        ))
+        elapsed = time.perf_counter() - started
+        mem_after, mem_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        admin_queries = counter.count
+        flush_messages()
+
+    total = sum(len(v) for v in latencies.values())
+    lines = [
+        f"Benchmark: {args.users} usuarios x {args.requests} consultas, {args.tenants} tenants, "
+        f"modo={args.mode}, latencia LLM={args.latency * 1000:.0f} ms, feedback={args.feedback_ratio:.0%}, "
+        f"answer_cache={'on' if args.answer_cache else 'off'}",
+        f"Duración: {elapsed:.2f} s   Requests: {total}   RPS: {total / elapsed:.1f}",
+    ]
+    for endpoint in ("query", "feedback"):
+        values = latencies[endpoint]
+        if not values:
+            continue
+        lines.append(
+            f"/{endpoint:<9} n={len(values):<5} errores={errors[endpoint]:<3} "
+            f"p50={percentile(values, 50) * 1000:8.1f} ms  p95={percentile(values, 95) * 1000:8.1f} ms  "
+            f"p99={percentile(values, 99) * 1000:8.1f} ms  max={max(values) * 1000:8.1f} ms"
+        )
+    lines += [
+        f"Admin DB: {admin_queries} consultas, {admin_queries / max(total, 1):.2f} por request",
+        f"Memoria (tracemalloc): +{(mem_after - mem_before) / 1024:.0f} KiB al final, "
+        f"pico {mem_peak / 1024:.0f} KiB; RSS máximo {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline de /query y /feedback con un LLM falso")
+    parser.add_argument("--users", type=int, default=10, help="usuarios concurrentes")
+    parser.add_argument("--requests", type=int, default=5, help="consultas por usuario")
+    parser.add_argument("--tenants", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05, help="segundos por llamada al LLM")
+    parser.add_argument("--mode", choices=("agent", "fast"), default="agent")
+    parser.add_argument("--feedback-ratio", type=float, default=0.3, help="fracción de consultas con feedback")
+    parser.add_argument("--answer-cache", action="store_true", help="habilitar el cache de respuestas")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="bench_output.txt")
+    args = parser.parse_args()
+    args.tenants = max(1, min(args.tenants, args.users))
+
+    workdir = tempfile.mkdtemp(prefix="sql_agent_bench_")
+    try:
+        report = asyncio.run(run_benchmark(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# cache.py
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Cache en memoria thread-safe con tamaño máximo (LRU) y expiración opcional.
+
+    - maxsize: cantidad máxima de entradas; al superarla se descarta la menos usada.
+    - ttl: segundos de vida de una entrada (None = sin expiración).
+    - refresh_on_get: si es True el TTL se renueva en cada acceso (expiración por inactividad).
+    - on_evict: callback(key, value) llamado cuando una entrada sale del cache.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: Optional[float] = None,
+        refresh_on_get: bool = False,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh_on_get = refresh_on_get
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expires_at(self):
+        return time.monotonic() + self.ttl if self.ttl else None
+
+    def _drop(self, key):
+        _, value = self._data.pop(key)
+        self.evictions += 1
+        if self.on_evict:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                print(f"Error liberando entrada de cache {key}: {e}")
+
+    def _lookup(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+        expires_at, value = item
+        if expires_at is not None and expires_at < time.monotonic():
+            self._drop(key)
+            return _MISSING
+        self._data.move_to_end(key)
+        if self.refresh_on_get:
+            self._data[key] = (self._expires_at(), value)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                old = self._data[key][1]
+                self._data.pop(key)
+                if old is not value and self.on_evict:
+                    self.on_evict(key, old)
+            self._data[key] = (self._expires_at(), value)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+
+    def get_or_create(self, key, factory: Callable[[], Any]):
+        """
+        Devuelve la entrada o la construye con factory() si no existe.
+        La construcción se serializa por clave, no bloquea al resto del cache.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                with self._lock:
+                    value = self._lookup(key)
+                if value is _MISSING:
+                    value = factory()
+                    self.set(key, value)
+                return value
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+
+    def invalidate(self, key) -> bool:
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+                return True
+            return False
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Invalida todas las entradas cuya clave cumple el predicado."""
+        with self._lock:
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                self._drop(k)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            for k in list(self._data):
+                self._drop(k)
+
+    def purge_expired(self) -> int:
+        """Elimina las entradas vencidas (útil para expiración por inactividad)."""
+        with self._lock:
+            now = time.monotonic()
+            keys = [k for k, (exp, _) in self._data.items() if exp is not None and exp < now]
+            for k in keys:
+                self._drop(k)
+            return len(keys)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and (item[0] is None or item[0] >= time.monotonic())
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+_MISSING = object()
@@ -1,6 +1,5 @@
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from agent import init_llm
+from functools import lru_cache
+from langchain_core.prompts import PromptTemplate
 
 clarify_prompt = PromptTemplate(
     input_variables=["schema", "pregunta"],
@@ -42,4 +41,15 @@ Usuario: "{pregunta}"
 """
 )
 
-clarificador_chain = LLMChain(llm=init_llm(), prompt=clarify_prompt)
+# La chain (y el cliente LLM) se crea recién al primer uso
+@lru_cache(maxsize=None)
+def get_chain():
+    from langchain.chains import LLMChain
+    from agent import init_llm
+    return LLMChain(llm=init_llm("clarificador"), prompt=clarify_prompt)
+
+def __getattr__(name):
+    # Compatibilidad con `from chains.clarificador import clarificador_chain`
+    if name == "clarificador_chain":
+        return get_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
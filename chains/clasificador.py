@@ -1,6 +1,5 @@
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from agent import init_llm
+from functools import lru_cache
+from langchain_core.prompts import PromptTemplate
 
 classify_prompt = PromptTemplate.from_template("""
 Sos un asistente que clasifica si una explicación fue útil para el usuario.
@@ -15,4 +14,15 @@ Clasificá esta respuesta como una de las siguientes opciones (solo una palabra)
 - no útil 
 """)
 
-clasificador_chain = LLMChain(llm=init_llm(), prompt=classify_prompt)
+# La chain (y el cliente LLM) se crea recién al primer uso
+@lru_cache(maxsize=None)
+def get_chain():
+    from langchain.chains import LLMChain
+    from agent import init_llm
+    return LLMChain(llm=init_llm("clasificador"), prompt=classify_prompt)
+
+def __getattr__(name):
+    # Compatibilidad con `from chains.clasificador import clasificador_chain`
+    if name == "clasificador_chain":
+        return get_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
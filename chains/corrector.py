@@ -1,6 +1,5 @@
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from agent import init_llm
+from functools import lru_cache
+from langchain_core.prompts import PromptTemplate
 
 correct_prompt = PromptTemplate.from_template("""
 La siguiente consulta SQL produjo un error al ejecutarse:
@@ -11,4 +10,15 @@ Error: {error}
 Corrige la consulta para que sea válida según el esquema y devuélvela (solo la SQL).
 """)
 
-corrector_chain = LLMChain(llm=init_llm(), prompt=correct_prompt)
+# La chain (y el cliente LLM) se crea recién al primer uso
+@lru_cache(maxsize=None)
+def get_chain():
+    from langchain.chains import LLMChain
+    from agent import init_llm
+    return LLMChain(llm=init_llm("corrector"), prompt=correct_prompt)
+
+def __getattr__(name):
+    # Compatibilidad con `from chains.corrector import corrector_chain`
+    if name == "corrector_chain":
+        return get_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
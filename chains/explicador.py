@@ -1,7 +1,6 @@
 
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from agent import init_llm
+from functools import lru_cache
+from langchain_core.prompts import PromptTemplate
 
 explain_prompt = PromptTemplate.from_template("""
 Tenés que explicarle al usuario un resultado de una consulta SQL que pidió en lenguaje natural, abstrayendolo por completo de la base de datos.
@@ -23,4 +22,15 @@ Explicá en lenguaje claro, conciso y sin jerga técnica, qué significan estos
 Finaliza con una pregunta o frase que busque el feedback del usuario sobre la utilidad de la explicación, como "¿Te resultó útil esta explicación?" o "¿Quedaste satisfecho con la respuesta?".
 """)
 
-explicador_chain = LLMChain(llm=init_llm(), prompt=explain_prompt)
+# La chain (y el cliente LLM) se crea recién al primer uso
+@lru_cache(maxsize=None)
+def get_chain():
+    from langchain.chains import LLMChain
+    from agent import init_llm
+    return LLMChain(llm=init_llm("explicador"), prompt=explain_prompt)
+
+def __getattr__(name):
+    # Compatibilidad con `from chains.explicador import explicador_chain`
+    if name == "explicador_chain":
+        return get_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,31 @@
+from functools import lru_cache
+from langchain_core.prompts import PromptTemplate
+
+generate_prompt = PromptTemplate.from_template("""
+Sos un experto en SQL para SQLite. Escribí UNA sola consulta SELECT que responda la pregunta del usuario.
+
+Tablas de la base (definición real):
+{tablas}
+
+Esquema semántico (qué significa cada tabla y columna):
+{schema}
+
+Contexto previo:
+{contexto}
+
+Pregunta del usuario:
+"{pregunta}"
+
+Aclaraciones:
+{aclaraciones}
+
+Usá solo tablas y columnas que existan en la definición. Si la pregunta no pide todas las filas, limitá el resultado a lo necesario.
+Devolvé únicamente la SQL, sin explicaciones ni bloques de código.
+""")
+
+# La chain (y el cliente LLM) se crea recién al primer uso
+@lru_cache(maxsize=None)
+def get_chain():
+    from langchain.chains import LLMChain
+    from agent import init_llm
+    return LLMChain(llm=init_llm("generador"), prompt=generate_prompt)
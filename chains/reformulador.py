@@ -1,6 +1,5 @@
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from agent import init_llm
+from functools import lru_cache
+from langchain_core.prompts import PromptTemplate
 
 reformulate_prompt = PromptTemplate.from_template("""
 Tenés una conversación previa con el usuario, en la que se intentó responder una pregunta en lenguaje natural transformándola en SQL. A continuación se incluye el historial y un comentario final del usuario.
@@ -15,4 +14,15 @@ Reformulá una nueva pregunta clara, específica y completa en lenguaje natural
 Solo devolvé la nueva pregunta, sin explicaciones adicionales.
 """)
 
-reformulador_chain = LLMChain(llm=init_llm(), prompt=reformulate_prompt)
+# La chain (y el cliente LLM) se crea recién al primer uso
+@lru_cache(maxsize=None)
+def get_chain():
+    from langchain.chains import LLMChain
+    from agent import init_llm
+    return LLMChain(llm=init_llm("reformulador"), prompt=reformulate_prompt)
+
+def __getattr__(name):
+    # Compatibilidad con `from chains.reformulador import reformulador_chain`
+    if name == "reformulador_chain":
+        return get_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,22 @@
+from functools import lru_cache
+from langchain_core.prompts import PromptTemplate
+
+summarize_prompt = PromptTemplate.from_template("""
+Mantenés un resumen de una conversación entre un usuario y un asistente que responde preguntas sobre una base de datos traduciéndolas a SQL.
+
+Resumen acumulado hasta ahora (puede estar vacío):
+{resumen_previo}
+
+Turnos nuevos de la conversación:
+{turnos}
+
+Actualizá el resumen incorporando los turnos nuevos. Conservá lo que sirva para entender preguntas futuras: qué datos consultó el usuario, filtros, períodos y criterios que aclaró, correcciones que hizo y conclusiones importantes de los resultados. Omití tablas de resultados completas, saludos y detalles que no aporten contexto.
+Respondé solo con el resumen actualizado, en texto plano y en no más de {max_palabras} palabras.
+""")
+
+# La chain (y el cliente LLM) se crea recién al primer uso
+@lru_cache(maxsize=None)
+def get_chain():
+    from langchain.chains import LLMChain
+    from agent import init_llm
+    return LLMChain(llm=init_llm("resumidor"), prompt=summarize_prompt)
@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -12,8 +13,148 @@ MEMORY_DIR = os.getenv("MEMORY_DIR", "./.memories")
 # LLM
 LLM_MODEL = "gemini-2.5-pro"
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Cliente LLM compartido
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 120))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))  # llamadas simultáneas por worker
+LLM_TENANT_RPM = float(os.getenv("LLM_TENANT_RPM", 120))  # llamadas por minuto por tenant (0 = sin límite)
+LLM_TENANT_BURST = int(os.getenv("LLM_TENANT_BURST", 20))
+LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", 30))  # segundos de espera antes de responder 429
+# Cache persistente de respuestas del LLM (temperature=0 => mismo prompt, misma respuesta)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./data/llm_cache.db")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 50_000))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))  # segundos
+# Chains que no usan el cache, separadas por coma (p.ej. "sql_agent,explicador")
+LLM_CACHE_DISABLED_CHAINS = {
+    c.strip() for c in os.getenv("LLM_CACHE_DISABLED_CHAINS", "").split(",") if c.strip()
+}
 default_max = 250_000
 MAX_TOKENS_CONTEXT = int(os.getenv("MAX_TOKENS_CONTEXT", default_max))
+# Tokens reservados para las instrucciones del prompt y la respuesta del modelo
+PROMPT_RESERVE_TOKENS = int(os.getenv("PROMPT_RESERVE_TOKENS", 4_000))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
 
 # Base de datos administrativa
 ADMIN_DB_URL = os.getenv("ADMIN_DB_URL", "sqlite:///./data/tenants.db")
+# Si no se define, se deriva de ADMIN_DB_URL (sqlite+aiosqlite / postgresql+asyncpg)
+ASYNC_ADMIN_DB_URL = os.getenv("ASYNC_ADMIN_DB_URL")
+
+# Pool de agentes SQL por (tenant, base)
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", 32))
+AGENT_POOL_TTL = float(os.getenv("AGENT_POOL_TTL", 1800))  # segundos
+
+# Engines de las bases de los tenants
+TENANT_ENGINE_MAX = int(os.getenv("TENANT_ENGINE_MAX", 64))
+TENANT_ENGINE_IDLE_TTL = float(os.getenv("TENANT_ENGINE_IDLE_TTL", 900))  # segundos sin uso
+TENANT_LOOKUP_TTL = float(os.getenv("TENANT_LOOKUP_TTL", 300))
+TENANT_POOL_SIZE = int(os.getenv("TENANT_POOL_SIZE", 5))
+TENANT_POOL_MAX_OVERFLOW = int(os.getenv("TENANT_POOL_MAX_OVERFLOW", 10))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 64 * 1024))
+# Pasar a WAL (lecturas concurrentes) las bases al registrarlas. Es persistente: cambia
+# el archivo del tenant y crea -wal/-shm al lado. false = no tocar el journal del cliente
+SQLITE_ENABLE_WAL = os.getenv("SQLITE_ENABLE_WAL", "true").lower() == "true"
+# Sentencias preparadas que sqlite3 conserva por conexión (el default de Python es 128)
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 256))
+
+# Cache de identidad: api_key -> usuario y nombre de tenant -> id
+IDENTITY_CACHE_MAX = int(os.getenv("IDENTITY_CACHE_MAX", 10_000))
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", 300))  # segundos
+# Con varios workers: archivo local donde se publican las invalidaciones ("" = desactivado)
+ADMIN_CACHE_SYNC_PATH = os.getenv("ADMIN_CACHE_SYNC_PATH", "")
+ADMIN_CACHE_SYNC_INTERVAL = float(os.getenv("ADMIN_CACHE_SYNC_INTERVAL", 1.0))  # segundos
+ADMIN_CACHE_SYNC_MAX_BYTES = int(os.getenv("ADMIN_CACHE_SYNC_MAX_BYTES", 1024 * 1024))
+
+# Buffer en memoria de los últimos turnos por usuario
+MEMORY_CACHE_USERS = int(os.getenv("MEMORY_CACHE_USERS", 1024))
+# Con varios workers, cada uno ve solo sus propias escrituras hasta que vence el buffer
+MEMORY_CACHE_TTL = float(os.getenv("MEMORY_CACHE_TTL", 120))  # segundos
+MEMORY_SCAN_BATCH = int(os.getenv("MEMORY_SCAN_BATCH", 200))
+
+# Resumen acumulado de la conversación: cuando los turnos sin resumir superan
+# MEMORY_SUMMARY_TRIGGER_TOKENS, un hilo en segundo plano pliega los más viejos en el
+# resumen y deja textuales solo los últimos MEMORY_RECENT_TOKENS
+MEMORY_SUMMARY_ENABLED = os.getenv("MEMORY_SUMMARY_ENABLED", "true").lower() == "true"
+MEMORY_SUMMARY_TRIGGER_TOKENS = int(os.getenv("MEMORY_SUMMARY_TRIGGER_TOKENS", 8_000))
+MEMORY_RECENT_TOKENS = int(os.getenv("MEMORY_RECENT_TOKENS", 2_000))
+MEMORY_SUMMARY_WORDS = int(os.getenv("MEMORY_SUMMARY_WORDS", 400))
+MEMORY_SUMMARY_CHUNK_TOKENS = int(os.getenv("MEMORY_SUMMARY_CHUNK_TOKENS", 12_000))  # por llamada al LLM
+MEMORY_SUMMARY_TURN_TOKENS = int(os.getenv("MEMORY_SUMMARY_TURN_TOKENS", 500))  # recorte por turno
+
+# Retención de chat_messages por tenant: {"*": {"ttl_days": 180}, "acme": {"ttl_days": 30, "max_rows": 50000}}
+# (0 o ausente = sin límite). Lo que sobra se archiva en un SQLite por tenant y mes.
+RETENTION_POLICIES = json.loads(os.getenv("RETENTION_POLICIES", "{}"))
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "./data/archive")
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", 1_000))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", 0))  # 0 = todas las páginas libres
+
+# Escritura diferida de mensajes (un hilo inserta en lotes)
+MEMORY_WRITE_BEHIND = os.getenv("MEMORY_WRITE_BEHIND", "true").lower() == "true"
+MEMORY_WRITE_BATCH = int(os.getenv("MEMORY_WRITE_BATCH", 100))
+MEMORY_WRITE_INTERVAL = float(os.getenv("MEMORY_WRITE_INTERVAL", 0.05))  # segundos
+# Espera máxima a que se escriba lo encolado antes de cargar un buffer desde la base
+MEMORY_FLUSH_TIMEOUT = float(os.getenv("MEMORY_FLUSH_TIMEOUT", 2.0))
+
+# Consultas concurrentes por tenant dentro de un worker
+TENANT_MAX_CONCURRENCY = int(os.getenv("TENANT_MAX_CONCURRENCY", 8))
+
+# Cache de respuestas por tenant/base (pregunta normalizada o muy similar)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 500))  # por base
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.9))  # Jaccard de trigramas
+
+# Precalentado de chains y cliente LLM: "off", "startup" (bloquea el arranque) o "background"
+WARMUP_MODE = os.getenv("WARMUP_MODE", "background")
+
+# Modo de ejecución de /query: "agent" (ReAct) o "fast" (una llamada genera la SQL y se
+# ejecuta directo; si falla se usa el agente). Se puede fijar por tenant o por request.
+SQL_MODE = os.getenv("SQL_MODE", "agent")
+SQL_MODE_BY_TENANT = json.loads(os.getenv("SQL_MODE_BY_TENANT", "{}"))  # {"acme": "fast"}
+# Especulación: la SQL se genera y ejecuta en paralelo con la clarificación y se
+# descarta si hace falta aclarar (ahorra una vuelta al LLM, gasta llamadas si se descarta)
+SPECULATIVE_SQL = os.getenv("SPECULATIVE_SQL", "false").lower() == "true"
+SPECULATIVE_SQL_BY_TENANT = json.loads(os.getenv("SPECULATIVE_SQL_BY_TENANT", "{}"))  # {"acme": true}
+# Poda del esquema: cada etapa recibe solo las tablas relevantes (BM25) y sus vecinas por FK
+SCHEMA_PRUNING_ENABLED = os.getenv("SCHEMA_PRUNING_ENABLED", "true").lower() == "true"
+SCHEMA_TOP_K = int(os.getenv("SCHEMA_TOP_K", 3))
+SCHEMA_MAX_TABLES = int(os.getenv("SCHEMA_MAX_TABLES", 8))
+SCHEMA_PRUNE_MIN_TABLES = int(os.getenv("SCHEMA_PRUNE_MIN_TABLES", 8))  # bases más chicas van completas
+# Intentos de reparación de una SQL inválida (primero local, después con corrector_chain)
+SQL_REPAIR_MAX_ATTEMPTS = int(os.getenv("SQL_REPAIR_MAX_ATTEMPTS", 2))
+# Presupuesto de ejecución de cada SQL sobre la base del tenant (0 = sin límite):
+# tiempo, instrucciones de la VM de SQLite y filas a recorrer sin índice según EXPLAIN QUERY PLAN
+SQL_TIMEOUT_SECONDS = float(os.getenv("SQL_TIMEOUT_SECONDS", 15))
+SQL_MAX_VM_STEPS = int(os.getenv("SQL_MAX_VM_STEPS", 500_000_000))
+SQL_MAX_SCAN_ROWS = int(os.getenv("SQL_MAX_SCAN_ROWS", 5_000_000))
+# {"acme": {"timeout_seconds": 5, "max_vm_steps": 100000000, "max_scan_rows": 1000000}}
+SQL_BUDGETS_BY_TENANT = json.loads(os.getenv("SQL_BUDGETS_BY_TENANT", "{}"))
+
+# Límites de resultados: lo que se lee de la base y lo que llega al LLM/memoria
+RESULT_MAX_ROWS = int(os.getenv("RESULT_MAX_ROWS", 100_000))
+RESULT_MAX_BYTES = int(os.getenv("RESULT_MAX_BYTES", 64 * 1024 * 1024))
+RESULT_PREVIEW_ROWS = int(os.getenv("RESULT_PREVIEW_ROWS", 50))
+RESULT_PREVIEW_BYTES = int(os.getenv("RESULT_PREVIEW_BYTES", 16 * 1024))
+RESULT_FETCH_BATCH = int(os.getenv("RESULT_FETCH_BATCH", 1_000))
+RESULT_TOP_K = int(os.getenv("RESULT_TOP_K", 5))
+RESULT_PAGE_SIZE_MAX = int(os.getenv("RESULT_PAGE_SIZE_MAX", 1_000))
+RESULT_REGISTRY_SIZE = int(os.getenv("RESULT_REGISTRY_SIZE", 10_000))
+RESULT_REGISTRY_TTL = float(os.getenv("RESULT_REGISTRY_TTL", 7 * 24 * 3600))  # segundos; luego el query_id caduca
+
+# Materialización de SQL frecuentes y caras en un SQLite aparte (<base>.mat.sqlite)
+MATERIALIZE_ENABLED = os.getenv("MATERIALIZE_ENABLED", "true").lower() == "true"
+MATERIALIZE_MIN_HITS = int(os.getenv("MATERIALIZE_MIN_HITS", 3))
+MATERIALIZE_MIN_MS = float(os.getenv("MATERIALIZE_MIN_MS", 200))  # latencia promedio
+MATERIALIZE_MAX_ROWS = int(os.getenv("MATERIALIZE_MAX_ROWS", 50_000))
+MATERIALIZE_MAX_TABLES = int(os.getenv("MATERIALIZE_MAX_TABLES", 20))  # por base
+MATERIALIZE_TRACK_MAX = int(os.getenv("MATERIALIZE_TRACK_MAX", 5_000))  # SQL distintas seguidas
+
+# Métricas (/metrics) y traza muestreada por request (una línea JSON por request)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Token para que Prometheus lea /metrics (Authorization: Bearer ...); sin él solo con X-ADMIN-KEY
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_TRACE_SAMPLE = float(os.getenv("METRICS_TRACE_SAMPLE", 0.0))  # fracción de requests, 0 = off
+METRICS_TRACE_PATH = os.getenv("METRICS_TRACE_PATH", "./data/traces.jsonl")
+
+# Exportación de resultados (/export): filas por lote
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", 10_000))
@@ -1,40 +1,216 @@
 # db.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
-from models import Base, Tenant, TenantDatabase
-from config import ADMIN_DB_URL
+from sqlalchemy.pool import QueuePool
+from models import Base, Tenant, TenantDatabase, ChatMessage
+from config import (
+    ADMIN_DB_URL, ASYNC_ADMIN_DB_URL, TENANT_ENGINE_MAX, TENANT_ENGINE_IDLE_TTL, TENANT_LOOKUP_TTL,
+    TENANT_POOL_SIZE, TENANT_POOL_MAX_OVERFLOW, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE_KB, SQLITE_STATEMENT_CACHE,
+    SQLITE_ENABLE_WAL,
+)
+from cache import LRUCache
+from metrics import admin_db_queries
+from tokens import count_tokens
+import hashlib
 import json
-from typing import Dict, Any
+import os
+import sqlite3
+from typing import Dict, Any, NamedTuple
 
 # Engine y sesión para la base de administración (tenants.db)
 admin_engine = create_engine(ADMIN_DB_URL)
 AdminSession = sessionmaker(bind=admin_engine)
 
+def _count_admin_query(*args):
+    admin_db_queries.inc()
+
+event.listen(admin_engine, "before_cursor_execute", _count_admin_query)
+
+# Engine async (se crea al primer uso, requiere aiosqlite/asyncpg según la URL).
+# False si falta el driver: las consultas van por la sesión sync en el threadpool
+_async_admin_session = None
+
+def _async_url(url: str) -> str:
+    if url.startswith("sqlite:///"):
+        return url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    if url.startswith(("postgresql://", "postgresql+psycopg2://")):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+def async_admin_available() -> bool:
+    """Crea el engine async si hace falta; False si el driver async no está instalado."""
+    global _async_admin_session
+    if _async_admin_session is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        url = ASYNC_ADMIN_DB_URL or _async_url(ADMIN_DB_URL)
+        try:
+            async_engine = create_async_engine(url)
+        except ImportError as e:
+            print(f"Sin driver async para {url.split('://', 1)[0]} ({e}): el admin DB se consulta en el threadpool")
+            _async_admin_session = False
+            return False
+        event.listen(async_engine.sync_engine, "before_cursor_execute", _count_admin_query)
+        _async_admin_session = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+    return _async_admin_session is not False
+
+def get_async_admin_session():
+    """Devuelve una nueva AsyncSession a tenants.db (usar con `async with`). Ver async_admin_available."""
+    if not async_admin_available():
+        raise RuntimeError("No hay driver async para el admin DB")
+    return _async_admin_session()
+
+# Callbacks a ejecutar cuando cambia el registro de una base (path o esquema).
+# Los usan los caches que dependen de (tenant, base), p.ej. el pool de agentes.
+_change_listeners = []
+
+def on_tenant_database_change(callback):
+    """Registra callback(tenant_name, base_name) para invalidar caches."""
+    _change_listeners.append(callback)
+    return callback
+
+def notify_tenant_database_change(tenant_name: str, base_name: str):
+    for callback in _change_listeners:
+        try:
+            callback(tenant_name, base_name)
+        except Exception as e:
+            print(f"Error invalidando cache de {tenant_name}/{base_name}: {e}")
+
+def _add_missing_columns(table):
+    """Agrega a una tabla existente las columnas (nullables) nuevas del modelo."""
+    existing = {c["name"] for c in inspect(admin_engine).get_columns(table.name)}
+    with admin_engine.begin() as conn:
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                col_type = column.type.compile(dialect=admin_engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+
 def init_admin_db():
     """Crea/abre las tablas admin: tenants + tenant_databases"""
     Base.metadata.create_all(admin_engine)
+    _add_missing_columns(ChatMessage.__table__)
+    # create_all no agrega índices nuevos a tablas que ya existían
+    for index in ChatMessage.__table__.indexes:
+        index.create(admin_engine, checkfirst=True)
 
 def get_admin_session():
     """Devuelve una nueva sesión a tenants.db"""
     return AdminSession()
 
-def get_tenant_db(tenant_name: str, base_name: str):
+# ----------------------------------------
+# Registro de engines de los tenants
+# ----------------------------------------
+
+# (tenant, base) -> db_path, evita el join contra la base admin en cada consulta
+_tenant_paths = LRUCache(maxsize=TENANT_ENGINE_MAX * 4, ttl=TENANT_LOOKUP_TTL)
+# db_path -> engine, se descarta (y cierra su pool) tras TENANT_ENGINE_IDLE_TTL sin uso
+_tenant_engines = LRUCache(
+    maxsize=TENANT_ENGINE_MAX,
+    ttl=TENANT_ENGINE_IDLE_TTL,
+    refresh_on_get=True,
+    on_evict=lambda path, engine: engine.dispose(),
+)
+
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    """
+    Configura cada conexión nueva para lecturas. Solo pragmas de la conexión: el
+    journal_mode es persistente y no se toca acá (ver enable_wal).
+    """
+    cursor = dbapi_conn.cursor()
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def _create_tenant_engine(path: str):
+    url = path if path.startswith("sqlite:///") else f"sqlite:///{path}"
+    engine_t = create_engine(
+        url,
+        connect_args={"check_same_thread": False, "cached_statements": SQLITE_STATEMENT_CACHE},  #sacar check_same_thread si no es sqlite
+        poolclass=QueuePool,
+        pool_size=TENANT_POOL_SIZE,
+        max_overflow=TENANT_POOL_MAX_OVERFLOW,
+    )
+    event.listen(engine_t, "connect", _set_sqlite_pragmas)
+    return engine_t
+
+def get_engine_for_path(path: str):
+    """Devuelve el engine compartido para el archivo SQLite indicado."""
+    _tenant_engines.purge_expired()
+    return _tenant_engines.get_or_create(path, lambda: _create_tenant_engine(path))
+
+def get_tenant_db_path(tenant_name: str, base_name: str) -> str:
+    """Devuelve el db_path registrado para (tenant, base), cacheado."""
+    key = (tenant_name, base_name)
+    path = _tenant_paths.get(key)
+    if path is not None:
+        return path
+
     db = AdminSession()
-    
     entry = (
         db.query(TenantDatabase)
           .join(Tenant)
           .filter(Tenant.name == tenant_name, TenantDatabase.base_name == base_name)
           .first()
     )
-    
     db.close()
     if not entry:
         raise ValueError(f"No se encontró base '{base_name}' para tenant '{tenant_name}'")
-    
-    path = entry.db_path
-    engine_t = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}) #sacar check_same_thread si no es sqlite
-    return sessionmaker(bind=engine_t)
+
+    _tenant_paths.set(key, entry.db_path)
+    return entry.db_path
+
+def sqlite_file_path(db_path: str) -> str:
+    return db_path[len("sqlite:///"):] if db_path.startswith("sqlite:///") else db_path
+
+def enable_wal(db_path: str) -> bool:
+    """
+    Pasa la base a journal_mode=WAL (una vez, al registrarla) para que las lecturas
+    concurrentes no se bloqueen con las escrituras del cliente. Es un cambio
+    persistente del archivo; con SQLITE_ENABLE_WAL=false no se hace.
+    """
+    if not SQLITE_ENABLE_WAL:
+        return False
+    path = sqlite_file_path(db_path)
+    if not os.path.exists(path):
+        return False
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute("PRAGMA journal_mode=WAL").fetchone()[0].lower() == "wal"
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        # Archivo de solo lectura o bloqueado: se queda con el journal actual
+        print(f"No se pudo pasar {path} a WAL: {e}")
+        return False
+
+def data_fingerprint(db_path: str) -> tuple:
+    """
+    Huella barata de los datos de un archivo SQLite: mtime y tamaño del archivo
+    y de su WAL. Cambia con cualquier escritura, sin abrir una conexión.
+    """
+    path = sqlite_file_path(db_path)
+    parts = []
+    for candidate in (path, path + "-wal"):
+        try:
+            st = os.stat(candidate)
+            parts.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            parts.append(None)
+    return tuple(parts)
+
+def get_tenant_engine(tenant_name: str, base_name: str):
+    return get_engine_for_path(get_tenant_db_path(tenant_name, base_name))
+
+def get_tenant_db(tenant_name: str, base_name: str):
+    return sessionmaker(bind=get_tenant_engine(tenant_name, base_name))
+
+@on_tenant_database_change
+def _invalidate_tenant_path(tenant_name: str, base_name: str):
+    _tenant_paths.invalidate((tenant_name, base_name))
+
+def tenant_engine_stats() -> dict:
+    return {"lookups": _tenant_paths.stats(), "engines": _tenant_engines.stats()}
 
 
 def create_tenant(name: str):
@@ -78,6 +254,8 @@ def register_tenant_database(tenant_name: str, base_name: str, db_path: str, sch
 
     db.commit()
     db.close()
+    enable_wal(db_path)
+    notify_tenant_database_change(tenant_name, base_name)
     print("Registro completado.")
 
 
@@ -96,34 +274,37 @@ def list_tenant_databases(tenant_name: str):
     db.close()
     return [(b.base_name, b.db_path) for b in bases]
 
-def get_schema_info(tenant_name: str, base_name: str) -> Dict[str, str]:
-    """
-    Get schema info and convert it to the format expected by LangChain.
-    Returns a dict where keys are table names and values are descriptive strings.
-    """
-    db = get_admin_session()
+class CompiledSchema(NamedTuple):
+    """Schema info already parsed and rendered for the prompts."""
+    version: str                # hash of the stored schema_info
+    tables: Dict[str, str]      # table_name -> LangChain description
+    text: str                   # pre-rendered text injected in the prompts
+    tokens: int                 # token count of text
 
-    result = (
-        db.query(TenantDatabase)
-        .join(Tenant)
-        .filter(Tenant.name == tenant_name, TenantDatabase.base_name == base_name)
-        .first()
-    )
 
-    db.close()
+# (tenant, base) -> CompiledSchema
+_schema_cache = LRUCache(maxsize=TENANT_ENGINE_MAX * 4, ttl=TENANT_LOOKUP_TTL)
 
-    if not result:
-        raise Exception(f"No se encontró la base {base_name} para el tenant {tenant_name}")
 
-    if not result.schema_info:
-        return {}
+def _schema_version(schema_data: Any) -> str:
+    canonical = json.dumps(schema_data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def _compile_schema_info(schema_info: Any) -> CompiledSchema:
+    """
+    Parse the stored schema_info (JSON string or dict) and convert it to the
+    format expected by LangChain (table_name -> description_string).
+    """
+    if not schema_info:
+        return CompiledSchema(_schema_version({}), {}, "", 0)
 
     try:
         # Parse the JSON string stored in schema_info
-        if isinstance(result.schema_info, str):
-            schema_data = json.loads(result.schema_info)
+        if isinstance(schema_info, str):
+            schema_data = json.loads(schema_info)
         else:
-            schema_data = result.schema_info
+            schema_data = schema_info
         
         # Convert to LangChain format (table_name -> description_string)
         langchain_format = {}
@@ -168,14 +349,63 @@ def get_schema_info(tenant_name: str, base_name: str) -> Dict[str, str]:
                 # Fallback for other types
                 langchain_format[table_name] = str(table_info)
         
-        return langchain_format
+        prompt_text = str(langchain_format) if langchain_format else ""
+        return CompiledSchema(
+            _schema_version(schema_data), langchain_format, prompt_text, count_tokens(prompt_text)
+        )
         
     except json.JSONDecodeError as e:
         print(f"Error parsing schema JSON: {e}")
-        return {}
+        return CompiledSchema(_schema_version({}), {}, "", 0)
     except Exception as e:
         print(f"Error processing schema: {e}")
-        return {}
+        return CompiledSchema(_schema_version({}), {}, "", 0)
+
+
+def get_compiled_schema(tenant_name: str, base_name: str) -> CompiledSchema:
+    """
+    Get the compiled schema for a tenant database.
+    Served from cache; the admin DB is only read on a miss.
+    """
+    key = (tenant_name, base_name)
+    compiled = _schema_cache.get(key)
+    if compiled is not None:
+        return compiled
+
+    db = get_admin_session()
+
+    result = (
+        db.query(TenantDatabase)
+        .join(Tenant)
+        .filter(Tenant.name == tenant_name, TenantDatabase.base_name == base_name)
+        .first()
+    )
+
+    db.close()
+
+    if not result:
+        raise Exception(f"No se encontró la base {base_name} para el tenant {tenant_name}")
+
+    compiled = _compile_schema_info(result.schema_info)
+    _schema_cache.set(key, compiled)
+    return compiled
+
+
+def get_schema_info(tenant_name: str, base_name: str) -> Dict[str, str]:
+    """
+    Get schema info and convert it to the format expected by LangChain.
+    Returns a dict where keys are table names and values are descriptive strings.
+    """
+    return dict(get_compiled_schema(tenant_name, base_name).tables)
+
+
+@on_tenant_database_change
+def _invalidate_schema(tenant_name: str, base_name: str):
+    _schema_cache.invalidate((tenant_name, base_name))
+
+
+def schema_cache_stats() -> dict:
+    return _schema_cache.stats()
 
 
 def set_schema_info(tenant_name: str, base_name: str, schema_info: Dict[str, Any]) -> bool:
@@ -206,6 +436,9 @@ def set_schema_info(tenant_name: str, base_name: str, schema_info: Dict[str, Any
         # Convert to JSON string for storage
         result.schema_info = json.dumps(schema_info, ensure_ascii=False, indent=2)
         db.commit()
+        notify_tenant_database_change(tenant_name, base_name)
+        # Leave the new version compiled so the next query doesn't parse it
+        _schema_cache.set((tenant_name, base_name), _compile_schema_info(schema_info))
         return True
         
     except Exception as e:
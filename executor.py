@@ -0,0 +1,622 @@
+# executor.py
+import datetime
+import difflib
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from cache import LRUCache
+from db import get_admin_session
+from materialize import materialized_source, record_execution, MATERIALIZED_SUFFIX
+from metrics import record_sql, sql_budget_exceeded
+from llm_provider import current_tenant
+from models import ExecutedQuery
+from config import (
+    TENANT_LOOKUP_TTL, TENANT_ENGINE_MAX, RESULT_PREVIEW_ROWS, RESULT_PREVIEW_BYTES,
+    RESULT_MAX_ROWS, RESULT_MAX_BYTES, RESULT_FETCH_BATCH, RESULT_TOP_K, RESULT_REGISTRY_SIZE,
+    RESULT_REGISTRY_TTL,
+    SQL_TIMEOUT_SECONDS, SQL_MAX_VM_STEPS, SQL_MAX_SCAN_ROWS, SQL_BUDGETS_BY_TENANT,
+)
+
+
+class SQLValidationError(ValueError):
+    """La SQL no es válida, no es de solo lectura o referencia algo inexistente."""
+
+
+class SQLBudgetExceeded(SQLValidationError):
+    """La SQL supera el presupuesto de ejecución del tenant (tiempo, pasos de la VM o filas a recorrer)."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Catalog(NamedTuple):
+    tables: Dict[str, List[str]]   # tabla -> columnas, según la base real
+    ddl: str                       # CREATE TABLE/VIEW de la base, para los prompts
+    table_ddl: Dict[str, str] = {}          # tabla -> su CREATE
+    references: Dict[str, List[str]] = {}   # tabla -> tablas a las que apuntan sus foreign keys
+    row_estimates: Dict[str, int] = {}      # tabla -> filas aproximadas (max(rowid))
+
+    def ddl_for(self, tables) -> str:
+        """DDL solo de las tablas indicadas (en el orden del catálogo)."""
+        wanted = set(tables)
+        return "\n\n".join(sql for name, sql in self.table_ddl.items() if name in wanted)
+
+
+# db_path -> Catalog
+_catalogs = LRUCache(maxsize=TENANT_ENGINE_MAX, ttl=TENANT_LOOKUP_TTL)
+
+
+def get_catalog(engine) -> Catalog:
+    """Tablas, columnas y DDL reflejados de la base del tenant (cacheado)."""
+    key = str(engine.url)
+
+    def reflect():
+        tables, table_ddl, references, row_estimates = {}, {}, {}, {}
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT name, sql, type FROM sqlite_master "
+                "WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%' ORDER BY name"
+            ).fetchall()
+            for name, sql, kind in rows:
+                cols = conn.exec_driver_sql(f'PRAGMA table_info("{name}")').fetchall()
+                tables[name] = [c[1] for c in cols]
+                fks = conn.exec_driver_sql(f'PRAGMA foreign_key_list("{name}")').fetchall()
+                references[name] = sorted({fk[2] for fk in fks})
+                if sql:
+                    table_ddl[name] = sql.strip() + ";"
+                if kind == "table":
+                    # max(rowid) sale del índice de la tabla: estimación sin recorrerla
+                    try:
+                        row_estimates[name] = conn.exec_driver_sql(f'SELECT max(rowid) FROM "{name}"').scalar() or 0
+                    except Exception:
+                        # Tabla WITHOUT ROWID: sin estimación
+                        pass
+        return Catalog(tables, "\n\n".join(table_ddl.values()), table_ddl, references, row_estimates)
+
+    return _catalogs.get_or_create(key, reflect)
+
+
+def extract_sql(text: str) -> str:
+    """Limpia la salida del LLM: bloques ```sql, prefijos y ';' final."""
+    text = text.strip()
+    fenced = re.search(r"```(?:sql|sqlite)?\s*(.*?)```", text, re.S | re.I)
+    if fenced:
+        text = fenced.group(1).strip()
+    text = re.sub(r"^(SQLQuery|SQL|Query)\s*:\s*", "", text, flags=re.I)
+    return text.strip().rstrip(";").strip()
+
+
+# Acciones permitidas durante la validación (todo lo demás se rechaza)
+_READ_ACTIONS = {
+    sqlite3.SQLITE_SELECT,
+    sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_FUNCTION,
+    getattr(sqlite3, "SQLITE_RECURSIVE", 33),
+}
+
+def _read_only_authorizer(action, arg1, arg2, db_name, trigger):
+    return sqlite3.SQLITE_OK if action in _READ_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def validate_sql(engine, sql: str):
+    """
+    Valida la SQL sin ejecutarla: una sola sentencia, de solo lectura, y que
+    SQLite pueda compilarla (sintaxis, tablas y columnas existentes, columnas
+    ambiguas en joins). Devuelve las filas de EXPLAIN QUERY PLAN.
+    """
+    if not sql:
+        raise SQLValidationError("La consulta está vacía")
+    if not re.match(r"^\s*(select|with)\b", sql, re.I):
+        raise SQLValidationError("Solo se permiten consultas SELECT")
+
+    with engine.connect() as conn:
+        raw = conn.connection.dbapi_connection
+        raw.set_authorizer(_read_only_authorizer)
+        try:
+            # EXPLAIN QUERY PLAN compila la sentencia: detecta errores de sintaxis e identificadores inexistentes
+            return raw.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        except sqlite3.DatabaseError as e:
+            # Incluye "You can only execute one statement at a time." (ProgrammingError)
+            message = str(e)
+            if "not authorized" in message:
+                message = "La consulta intenta modificar la base o usar operaciones no permitidas"
+            raise SQLValidationError(message) from e
+        finally:
+            raw.set_authorizer(None)
+
+
+# ----------------------------------------
+# Presupuesto de ejecución por tenant
+# ----------------------------------------
+
+class SQLBudget(NamedTuple):
+    timeout_seconds: float
+    max_vm_steps: int
+    max_scan_rows: int
+
+
+def budget_for(tenant_name: Optional[str]) -> SQLBudget:
+    """Presupuesto global con lo que el tenant defina en SQL_BUDGETS_BY_TENANT."""
+    overrides = SQL_BUDGETS_BY_TENANT.get(tenant_name, {}) if tenant_name else {}
+    return SQLBudget(
+        float(overrides.get("timeout_seconds", SQL_TIMEOUT_SECONDS)),
+        int(overrides.get("max_vm_steps", SQL_MAX_VM_STEPS)),
+        int(overrides.get("max_scan_rows", SQL_MAX_SCAN_ROWS)),
+    )
+
+
+_budget_stats = Counter()
+
+# Instrucciones de la VM entre cada llamada al progress handler
+_PROGRESS_INTERVAL = 1_000
+
+_SIMPLIFY_HINT = "Filtrá por columnas indexadas, revisá las condiciones de los joins (sin productos cartesianos) o agregá un LIMIT"
+
+
+def _budget_error(tenant_name: Optional[str], reason: str, message: str) -> SQLBudgetExceeded:
+    _budget_stats[reason] += 1
+    sql_budget_exceeded.inc(tenant=tenant_name or "", reason=reason)
+    return SQLBudgetExceeded(reason, message)
+
+
+# "SCAN t", "SCAN tracks USING COVERING INDEX ...", "SCAN CONSTANT ROW" y el formato viejo "SCAN TABLE tracks AS t"
+_PLAN_SCAN = re.compile(r'^SCAN (?:TABLE )?(.+?)(?: AS \S+)?(?: USING .*| VIRTUAL TABLE.*)?$', re.I)
+# Nodos cuyo resultado se lee después con "SCAN <nombre>": CTEs y subconsultas del FROM
+_PLAN_SOURCE = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (.+)$', re.I)
+
+_IDENTIFIER = r'"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+'
+_FROM_ITEM = re.compile(rf'\s*({_IDENTIFIER})(?:\s*\.\s*({_IDENTIFIER}))?')
+_FROM_ALIAS = re.compile(rf'\s+(?:as\s+)?({_IDENTIFIER})', re.I)
+_NOT_ALIASES = {
+    "where", "on", "using", "join", "inner", "left", "right", "full", "outer", "cross", "natural",
+    "group", "order", "limit", "having", "window", "union", "except", "intersect", "as", "indexed", "not",
+}
+
+
+def _unquote(name: str) -> str:
+    return name.strip('"`[]').lower()
+
+
+def _skip_parens(text: str, pos: int) -> int:
+    """Posición siguiente al paréntesis que cierra el que abre en pos."""
+    depth = 0
+    for i in range(pos, len(text)):
+        if text[i] == "(":
+            depth += 1
+        elif text[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return len(text)
+
+
+def _source_aliases(sql: str) -> Dict[str, str]:
+    """alias -> tabla o CTE, solo de los elementos de FROM/JOIN (no de la lista del SELECT)."""
+    text = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    aliases = {}
+    for keyword in re.finditer(r"\b(?:from|join)\b", text, re.I):
+        pos = keyword.end()
+        while True:
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+            source = None
+            if text.startswith("(", pos):
+                # Subconsulta: SQLite la nombra por su alias o la aplana en sus tablas
+                pos = _skip_parens(text, pos)
+            else:
+                item = _FROM_ITEM.match(text, pos)
+                if item is None:
+                    break
+                source = _unquote(item.group(2) or item.group(1))
+                pos = item.end()
+                if text.startswith("(", pos):
+                    # Función de tabla (json_each(...))
+                    pos = _skip_parens(text, pos)
+            alias = _FROM_ALIAS.match(text, pos)
+            if alias and _unquote(alias.group(1)) not in _NOT_ALIASES:
+                if source:
+                    aliases[_unquote(alias.group(1))] = source
+                pos = alias.end()
+            rest = re.match(r"\s*,", text[pos:])
+            if rest is None:
+                break
+            pos += rest.end()
+    return aliases
+
+
+def estimate_scan_rows(plan: List[tuple], catalog: Catalog, sql: str) -> int:
+    """
+    Filas que recorrería el plan sin índices, recorriendo el árbol de EXPLAIN QUERY PLAN:
+    - en cada nivel los SCAN son un nested loop: sus filas se multiplican;
+    - las CTEs y subconsultas materializadas (MATERIALIZE/CO-ROUTINE) se cuentan una
+      vez y sus filas estimadas se usan cuando el nivel las recorre por nombre o alias;
+    - una subconsulta correlacionada se ejecuta por cada fila del nivel que la contiene;
+    - las demás subconsultas se ejecutan una vez.
+    Lo que no tiene estimación (p.ej. CTEs recursivas) cuenta como una fila. Es una
+    cota por arriba: una CTE agrupada se estima con las filas que recorre, no las que devuelve.
+    """
+    rows_by_table = {t.lower(): n for t, n in catalog.row_estimates.items()}
+    aliases = _source_aliases(sql)
+    children: Dict[int, List[tuple]] = {}
+    for node_id, parent, _, detail in plan:
+        children.setdefault(parent, []).append((node_id, detail))
+    sources: Dict[str, int] = {}   # CTE o subconsulta -> filas estimadas de su resultado
+
+    def rows_for(name: str) -> int:
+        name = _unquote(name)
+        for candidate in (name, aliases.get(name)):
+            if candidate in sources:
+                return sources[candidate]
+            if candidate in rows_by_table:
+                return max(rows_by_table[candidate], 1)
+        return 1
+
+    def level_cost(node_id: int):
+        """(filas del nested loop de este nivel, filas recorridas en total)."""
+        nodes = children.get(node_id, [])
+        work = 0
+        # Primero lo que produce resultados que el nivel después recorre por nombre
+        for child_id, detail in nodes:
+            if _PLAN_SCAN.match(detail) or detail.upper().startswith(("SEARCH", "CORRELATED")):
+                continue
+            loop_rows, child_work = level_cost(child_id)
+            work += child_work
+            source = _PLAN_SOURCE.match(detail)
+            if source:
+                sources[_unquote(source.group(1))] = loop_rows
+        loop_rows = 1
+        for _, detail in nodes:
+            scan = _PLAN_SCAN.match(detail)
+            if scan:
+                loop_rows *= rows_for(scan.group(1))
+        if any(_PLAN_SCAN.match(detail) for _, detail in nodes):
+            work += loop_rows
+        for child_id, detail in nodes:
+            if detail.upper().startswith("CORRELATED"):
+                work += loop_rows * level_cost(child_id)[1]
+        return loop_rows, work
+
+    return level_cost(0)[1]
+
+
+def check_scan_budget(engine, plan: List[tuple], sql: str, tenant_name: Optional[str] = None):
+    """Rechaza antes de ejecutar las SQL que recorrerían más filas que max_scan_rows."""
+    tenant_name = tenant_name or current_tenant.get()
+    budget = budget_for(tenant_name)
+    if budget.max_scan_rows <= 0:
+        return
+    estimate = estimate_scan_rows(plan, get_catalog(engine), sql)
+    if estimate > budget.max_scan_rows:
+        raise _budget_error(
+            tenant_name, "scan",
+            f"La consulta recorrería unas {estimate:,} filas sin usar índices "
+            f"(máximo {budget.max_scan_rows:,}). {_SIMPLIFY_HINT}.",
+        )
+
+
+def check_sql_budget(engine, sql: str, tenant_name: Optional[str] = None):
+    """check_scan_budget con el plan de la SQL (para quien no lo tiene de validate_sql)."""
+    with engine.connect() as conn:
+        plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    check_scan_budget(engine, plan, sql, tenant_name)
+
+
+@contextmanager
+def execution_budget(conn, tenant_name: Optional[str] = None, cancel: threading.Event = None):
+    """
+    Corta la SQL que se ejecute en la conexión dentro del bloque si supera el tiempo
+    o los pasos de la VM del tenant, o si se activa cancel (el request se canceló).
+    Usa el progress handler de SQLite: la consulta se interrumpe dentro de la base.
+    Devuelve paused(): el tiempo dentro de `with paused():` no cuenta (p.ej. mientras
+    un export espera a que el cliente consuma el lote).
+    """
+    tenant_name = tenant_name or current_tenant.get()
+    budget = budget_for(tenant_name)
+    state = {
+        "steps": 0,
+        "reason": None,
+        "deadline": time.monotonic() + budget.timeout_seconds if budget.timeout_seconds > 0 else None,
+    }
+
+    @contextmanager
+    def paused():
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if state["deadline"] is not None:
+                state["deadline"] += time.monotonic() - started
+
+    def progress():
+        state["steps"] += _PROGRESS_INTERVAL
+        if cancel is not None and cancel.is_set():
+            state["reason"] = "cancelled"
+        elif budget.max_vm_steps > 0 and state["steps"] > budget.max_vm_steps:
+            state["reason"] = "vm_steps"
+        elif state["deadline"] is not None and time.monotonic() > state["deadline"]:
+            state["reason"] = "timeout"
+        return 1 if state["reason"] else 0
+
+    raw = conn.connection.dbapi_connection
+    raw.set_progress_handler(progress, _PROGRESS_INTERVAL)
+    try:
+        yield paused
+    except Exception as e:
+        reason = state["reason"]
+        if reason is None:
+            raise
+        messages = {
+            "timeout": f"La consulta superó el tiempo máximo de {budget.timeout_seconds:g} s. {_SIMPLIFY_HINT}.",
+            "vm_steps": f"La consulta superó el máximo de {budget.max_vm_steps:,} pasos de ejecución. {_SIMPLIFY_HINT}.",
+            "cancelled": "La consulta se canceló",
+        }
+        raise _budget_error(tenant_name, reason, messages[reason]) from e
+    finally:
+        # La conexión vuelve al pool: sin handler
+        raw.set_progress_handler(None, 0)
+
+
+def budget_stats() -> dict:
+    return dict(_budget_stats)
+
+
+def error_message(error: Exception) -> str:
+    """Mensaje del error de SQLite, sin el envoltorio de SQLAlchemy."""
+    return str(getattr(error, "orig", None) or error)
+
+
+# ----------------------------------------
+# Resultados acotados
+# ----------------------------------------
+
+class ColumnSummary:
+    """Resumen incremental de una columna: cantidad, nulos, mín/máx y valores más frecuentes."""
+
+    def __init__(self, top_k: int = RESULT_TOP_K):
+        self.top_k = top_k
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self._comparable = True
+        self._freq = Counter()
+
+    def add(self, value):
+        self.count += 1
+        if value is None:
+            self.nulls += 1
+            return
+        if self._comparable:
+            try:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+            except TypeError:
+                # Tipos mezclados (SQLite es dinámico): no hay orden
+                self._comparable = False
+                self.min = self.max = None
+        key = value if isinstance(value, (int, float, str)) else repr(value)
+        self._freq[key] += 1
+        # Frecuencias aproximadas con memoria acotada
+        if len(self._freq) > self.top_k * 50:
+            self._freq = Counter(dict(self._freq.most_common(self.top_k * 10)))
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "nulls": self.nulls,
+            "min": self.min,
+            "max": self.max,
+            "top": self._freq.most_common(self.top_k),
+        }
+
+
+class QueryResult(NamedTuple):
+    columns: List[str]
+    preview: List[tuple]          # primeras filas, dentro de RESULT_PREVIEW_ROWS/BYTES
+    row_count: int                # filas leídas (hasta RESULT_MAX_ROWS)
+    truncated: bool               # se cortó la lectura por filas o bytes
+    summaries: Dict[str, dict]
+
+
+def run_governed(engine, sql: str, max_rows: int = RESULT_MAX_ROWS, max_bytes: int = RESULT_MAX_BYTES,
+                 preview_rows: int = RESULT_PREVIEW_ROWS, preview_bytes: int = RESULT_PREVIEW_BYTES,
+                 cancel: threading.Event = None) -> QueryResult:
+    """
+    Ejecuta la SQL leyendo en lotes con un cursor en streaming. Conserva solo una
+    vista previa y los resúmenes por columna; corta al llegar a max_rows o max_bytes.
+    Aplica el presupuesto del tenant: rechaza los planes que recorren demasiadas
+    filas y corta la ejecución por tiempo, pasos de la VM o cancelación.
+    """
+    db_path = engine.url.database
+    source = None if db_path.endswith(MATERIALIZED_SUFFIX) else materialized_source(db_path, sql)
+    if source is not None:
+        # SQL frecuente y cara: se lee de la tabla materializada vigente
+        engine, sql = source
+    started = time.perf_counter()
+    preview, preview_size = [], 0
+    row_count, total_bytes, truncated = 0, 0, False
+    with engine.connect() as conn:
+        if source is None:
+            plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            check_scan_budget(engine, plan, sql)
+        with execution_budget(conn, cancel=cancel):
+            result = conn.execution_options(stream_results=True).exec_driver_sql(sql)
+            columns = list(result.keys())
+            summaries = [ColumnSummary() for _ in columns]
+            while not truncated:
+                batch = result.fetchmany(RESULT_FETCH_BATCH)
+                if not batch:
+                    break
+                for row in batch:
+                    if row_count >= max_rows or total_bytes >= max_bytes:
+                        truncated = True
+                        break
+                    row = tuple(row)
+                    size = len(repr(row))
+                    row_count += 1
+                    total_bytes += size
+                    for summary, value in zip(summaries, row):
+                        summary.add(value)
+                    if len(preview) < preview_rows and preview_size + size <= preview_bytes:
+                        preview.append(row)
+                        preview_size += size
+            result.close()
+    elapsed = time.perf_counter() - started
+    record_sql(current_tenant.get(), elapsed, row_count, "materialized" if source is not None else "base")
+    if source is None and not truncated:
+        record_execution(db_path, sql, elapsed * 1000)
+    return QueryResult(
+        columns, preview, row_count, truncated,
+        {col: summary.to_dict() for col, summary in zip(columns, summaries)},
+    )
+
+
+def format_result(result: QueryResult) -> str:
+    """
+    Texto compacto para el LLM y la memoria. Si entra completo en la vista previa
+    mantiene el formato de SQLDatabase.run; si no, agrega totales y resúmenes.
+    """
+    if not result.truncated and len(result.preview) == result.row_count:
+        return str(result.preview)
+
+    total = f"{result.row_count}+" if result.truncated else str(result.row_count)
+    lines = [
+        f"Filas: {total} (se muestran {len(result.preview)})",
+        f"Columnas: {', '.join(result.columns)}",
+        str(result.preview),
+        "Resumen por columna:",
+    ]
+    for col, summary in result.summaries.items():
+        lines.append(
+            f"- {col}: no nulos={summary['count'] - summary['nulls']}, "
+            f"min={summary['min']!r}, max={summary['max']!r}, más frecuentes={summary['top']}"
+        )
+    return "\n".join(lines)
+
+
+def execute_sql(engine, sql: str, cancel: threading.Event = None) -> str:
+    """Ejecuta la SQL con límites de filas/bytes y devuelve el texto compacto del resultado."""
+    return format_result(run_governed(engine, sql, cancel=cancel))
+
+
+def fetch_page(engine, sql: str, offset: int, limit: int, tenant_name: str = None):
+    """Una página del resultado completo: (columnas, filas)."""
+    with engine.connect() as conn, execution_budget(conn, tenant_name):
+        result = conn.exec_driver_sql(
+            f"SELECT * FROM ({sql}) LIMIT ? OFFSET ?", (limit, offset)
+        )
+        return list(result.keys()), [list(row) for row in result.fetchall()]
+
+
+# ----------------------------------------
+# Registro de consultas ejecutadas (query_id -> SQL final)
+# ----------------------------------------
+
+class RegisteredQuery(NamedTuple):
+    tenant_name: str
+    base_name: str
+    user_id: Any
+    sql: str
+    created_at: datetime.datetime
+
+# Las recientes se sirven desde memoria; la tabla executed_queries las conserva
+# para otros workers y reinicios hasta RESULT_REGISTRY_TTL (retention.py las purga)
+_queries = LRUCache(maxsize=RESULT_REGISTRY_SIZE, ttl=RESULT_REGISTRY_TTL)
+_query_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-registry")
+
+def _persist_query(query_id: str, query: RegisteredQuery):
+    db = get_admin_session()
+    try:
+        db.add(ExecutedQuery(
+            id=query_id,
+            tenant_name=query.tenant_name,
+            base_name=query.base_name,
+            user_id=query.user_id,
+            sql=query.sql,
+            created_at=query.created_at,
+        ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Error guardando la consulta {query_id}: {e}")
+    finally:
+        db.close()
+
+def register_query(tenant_name: str, base_name: str, user_id, sql: str) -> str:
+    """Registra la SQL final de una consulta y devuelve su query_id."""
+    query_id = uuid.uuid4().hex
+    query = RegisteredQuery(tenant_name, base_name, user_id, sql, datetime.datetime.utcnow())
+    _queries.set(query_id, query)
+    _query_writer.submit(_persist_query, query_id, query)
+    return query_id
+
+def registry_cutoff() -> datetime.datetime:
+    """Las consultas registradas antes de este momento ya caducaron."""
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=RESULT_REGISTRY_TTL)
+
+def get_registered_query(query_id: str) -> Optional[RegisteredQuery]:
+    query = _queries.get(query_id)
+    if query is None:
+        db = get_admin_session()
+        row = db.query(ExecutedQuery).get(query_id)
+        db.close()
+        if row is None:
+            return None
+        query = RegisteredQuery(row.tenant_name, row.base_name, row.user_id, row.sql, row.created_at)
+        _queries.set(query_id, query)
+    # Las cargadas del DB pueden llevar tiempo creadas: el TTL cuenta desde created_at
+    if query.created_at is None or query.created_at < registry_cutoff():
+        _queries.invalidate(query_id)
+        return None
+    return query
+
+
+def _replace_identifier(sql: str, old: str, new: str) -> str:
+    # Reemplaza el identificador completo (con o sin comillas), fuera de los literales '...'
+    pattern = r'(?<!\w)(["`\[]?)' + re.escape(old) + r'(["`\]]?)(?!\w)'
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(pattern, lambda m: f"{m.group(1)}{new}{m.group(2)}", parts[i], flags=re.I)
+    return "".join(parts)
+
+
+def _closest(name: str, candidates) -> str:
+    by_lower = {c.lower(): c for c in candidates}
+    if name.lower() in by_lower:
+        return by_lower[name.lower()]
+    match = difflib.get_close_matches(name.lower(), list(by_lower), n=1, cutoff=0.75)
+    return by_lower[match[0]] if match else None
+
+
+def fuzzy_fix(sql: str, error: str, catalog: Catalog):
+    """
+    Intenta arreglar localmente errores de identificadores (mayúsculas o typos)
+    usando el catálogo real. Devuelve la SQL corregida o None si no aplica.
+    """
+    match = re.search(r"no such table: (?:\w+\.)?([\w]+)", error)
+    if match:
+        wrong = match.group(1)
+        right = _closest(wrong, catalog.tables)
+        if right and right != wrong:
+            return _replace_identifier(sql, wrong, right)
+        return None
+
+    match = re.search(r"no such column: (?:([\w]+)\.)?([\w]+)", error)
+    if match:
+        qualifier, wrong = match.groups()
+        table = _closest(qualifier, catalog.tables) if qualifier else None
+        candidates = catalog.tables[table] if table else {c for cols in catalog.tables.values() for c in cols}
+        right = _closest(wrong, candidates)
+        if right and right != wrong:
+            return _replace_identifier(sql, wrong, right)
+    return None
@@ -0,0 +1,155 @@
+# export.py
+import csv
+import io
+
+from executor import execution_budget
+from config import EXPORT_BATCH_ROWS
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class ExportUnavailable(Exception):
+    """El formato pedido necesita una dependencia opcional que no está instalada."""
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise ExportUnavailable("Los formatos arrow y parquet requieren pyarrow (pip install pyarrow)")
+
+
+def _iter_batches(engine, sql: str, batch_rows: int, tenant_name: str = None):
+    """
+    Lee la SQL con un cursor en streaming: (columnas, lote de filas) de a batch_rows.
+    Con el presupuesto de ejecución del tenant, igual que las consultas de /query;
+    el tiempo que el cliente tarda en consumir cada lote no cuenta.
+    """
+    with engine.connect() as conn, execution_budget(conn, tenant_name) as paused:
+        result = conn.execution_options(stream_results=True).exec_driver_sql(sql)
+        columns = list(result.keys())
+        try:
+            while True:
+                rows = result.fetchmany(batch_rows)
+                if not rows:
+                    break
+                with paused():
+                    yield columns, rows
+        finally:
+            result.close()
+
+
+def _columns(engine, sql: str):
+    with engine.connect() as conn:
+        return list(conn.exec_driver_sql(f"SELECT * FROM ({sql}) LIMIT 0").keys())
+
+
+def _iter_csv(engine, sql: str, batch_rows: int, tenant_name: str = None):
+    header_sent = False
+    for columns, rows in _iter_batches(engine, sql, batch_rows, tenant_name):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not header_sent:
+            writer.writerow(columns)
+            header_sent = True
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+    if not header_sent:
+        # Resultado vacío: al menos los nombres de columna
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(_columns(engine, sql))
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Archivo de solo escritura que acumula bytes para ir devolviéndolos por partes."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _column_array(pa, values, field=None):
+    text = [None if v is None else str(v) for v in values]
+    if field is None:
+        # Primer lote: se infiere el tipo; columnas nulas o con tipos mezclados van como texto
+        try:
+            array = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array(text, type=pa.string())
+        return pa.array(text, type=pa.string()) if pa.types.is_null(array.type) else array
+    try:
+        return pa.array(values, type=field.type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if pa.types.is_string(field.type):
+            return pa.array(text, type=pa.string())
+        raise ValueError(
+            f"La columna '{field.name}' mezcla tipos entre filas; exportala en formato csv"
+        )
+
+
+def _record_batch(pa, columns, rows, schema=None):
+    values = [list(col) for col in zip(*rows)]
+    if schema is None:
+        arrays = [_column_array(pa, col) for col in values]
+        schema = pa.schema([pa.field(name, array.type) for name, array in zip(columns, arrays)])
+    else:
+        arrays = [_column_array(pa, col, field) for col, field in zip(values, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema), schema
+
+
+def _iter_arrow(engine, sql: str, batch_rows: int, parquet: bool, tenant_name: str = None):
+    pa = _require_pyarrow()
+    if parquet:
+        import pyarrow.parquet as pq
+    sink = _ChunkSink()
+    out = pa.PythonFile(sink, mode="w")
+    writer, schema = None, None
+    for columns, rows in _iter_batches(engine, sql, batch_rows, tenant_name):
+        batch, schema = _record_batch(pa, columns, rows, schema)
+        if writer is None:
+            writer = pq.ParquetWriter(out, schema) if parquet else pa.ipc.new_stream(out, schema)
+        if parquet:
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        data = sink.drain()
+        if data:
+            yield data
+    if writer is None:
+        # Resultado vacío: un archivo válido con las columnas (como texto) y sin filas
+        schema = pa.schema([pa.field(name, pa.string()) for name in _columns(engine, sql)])
+        writer = pq.ParquetWriter(out, schema) if parquet else pa.ipc.new_stream(out, schema)
+    writer.close()
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def iter_export(engine, sql: str, fmt: str, batch_rows: int = EXPORT_BATCH_ROWS, tenant_name: str = None):
+    """
+    Generador de bytes con el resultado completo en el formato pedido, de a lotes
+    de batch_rows filas y sin pasar por el LLM. Memoria constante en el tamaño del lote.
+    """
+    if fmt == "csv":
+        return _iter_csv(engine, sql, batch_rows, tenant_name)
+    if fmt in ("arrow", "parquet"):
+        _require_pyarrow()
+        return _iter_arrow(engine, sql, batch_rows, parquet=fmt == "parquet", tenant_name=tenant_name)
+    raise ValueError(f"Formato no soportado: {fmt}")
@@ -0,0 +1,215 @@
+# identity.py
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from cache import LRUCache
+from db import (
+    get_admin_session, get_async_admin_session, async_admin_available, on_tenant_database_change,
+    notify_tenant_database_change,
+)
+from models import User, Tenant
+from config import (
+    IDENTITY_CACHE_MAX, IDENTITY_CACHE_TTL, ADMIN_CACHE_SYNC_PATH, ADMIN_CACHE_SYNC_INTERVAL,
+    ADMIN_CACHE_SYNC_MAX_BYTES,
+)
+
+
+class CachedUser(NamedTuple):
+    """Lo que los endpoints usan del usuario autenticado, sin sesión abierta."""
+    id: int
+    username: str
+    api_key: str
+    tenant_id: int
+
+
+# api_key -> CachedUser y nombre de tenant -> id. Solo se cachean los aciertos:
+# una api_key o un tenant recién creados se ven en la siguiente consulta.
+_users = LRUCache(maxsize=IDENTITY_CACHE_MAX, ttl=IDENTITY_CACHE_TTL)
+_tenant_ids = LRUCache(maxsize=IDENTITY_CACHE_MAX, ttl=IDENTITY_CACHE_TTL)
+
+
+# ----------------------------------------
+# Sincronización entre workers
+# ----------------------------------------
+# Con varios workers, cada invalidación se agrega como una línea JSON a un archivo
+# local compartido (ADMIN_CACHE_SYNC_PATH). Cada worker lee lo nuevo desde su último
+# offset y aplica las invalidaciones de los demás. Si el archivo se trunca o rota,
+# se descarta todo el cache de identidad.
+
+_sync_lock = threading.Lock()
+_sync_state = {"offset": None, "checked_at": 0.0}
+_applying = threading.local()
+
+
+def _publish(event: list):
+    if not ADMIN_CACHE_SYNC_PATH or getattr(_applying, "active", False):
+        return
+    line = (json.dumps(event) + "\n").encode("utf-8")
+    try:
+        fd = os.open(ADMIN_CACHE_SYNC_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            if os.fstat(fd).st_size > ADMIN_CACHE_SYNC_MAX_BYTES:
+                # Rotación: los demás workers ven el archivo más chico y limpian todo
+                os.ftruncate(fd, 0)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Error publicando invalidación de cache: {e}")
+
+
+def _apply(event: list):
+    kind = event[0]
+    if kind == "user":
+        _users.invalidate(event[1])
+    elif kind == "tenant":
+        _tenant_ids.invalidate(event[1])
+        _users.clear()
+    elif kind == "database":
+        notify_tenant_database_change(event[1], event[2])
+    else:
+        _users.clear()
+        _tenant_ids.clear()
+
+
+def sync_invalidations(force: bool = False):
+    """Aplica las invalidaciones publicadas por otros workers (a lo sumo cada ADMIN_CACHE_SYNC_INTERVAL)."""
+    if not ADMIN_CACHE_SYNC_PATH:
+        return
+    now = time.monotonic()
+    if not force and now - _sync_state["checked_at"] < ADMIN_CACHE_SYNC_INTERVAL:
+        return
+    with _sync_lock:
+        _sync_state["checked_at"] = now
+        try:
+            size = os.stat(ADMIN_CACHE_SYNC_PATH).st_size
+        except FileNotFoundError:
+            size = 0
+        offset = _sync_state["offset"]
+        if offset is None:
+            # Al arrancar el cache está vacío: solo importa lo que venga después
+            _sync_state["offset"] = size
+            return
+        if size == offset:
+            return
+        events = []
+        if size < offset:
+            events.append(["all"])
+            offset = 0
+        try:
+            with open(ADMIN_CACHE_SYNC_PATH, "rb") as f:
+                f.seek(offset)
+                data = f.read(size - offset)
+        except OSError as e:
+            print(f"Error leyendo invalidaciones de cache: {e}")
+            return
+        # Una línea a medio escribir se deja para la próxima lectura
+        complete = data.rfind(b"\n") + 1
+        _sync_state["offset"] = offset + complete
+        for line in data[:complete].splitlines():
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                events.append(["all"])
+        _applying.active = True
+        try:
+            for event in events:
+                _apply(event)
+        finally:
+            _applying.active = False
+
+
+@on_tenant_database_change
+def _publish_database_change(tenant_name: str, base_name: str):
+    _publish(["database", tenant_name, base_name])
+
+
+# ----------------------------------------
+# Consultas cacheadas
+# ----------------------------------------
+
+def _load_user(api_key: str) -> Optional[User]:
+    db = get_admin_session()
+    try:
+        return db.query(User).filter_by(api_key=api_key).first()
+    finally:
+        db.close()
+
+async def get_user_by_api_key(api_key: str) -> Optional[CachedUser]:
+    sync_invalidations()
+    user = _users.get(api_key)
+    if user is not None:
+        return user
+    if async_admin_available():
+        async with get_async_admin_session() as db:
+            result = await db.execute(select(User).filter_by(api_key=api_key))
+            row = result.scalars().first()
+    else:
+        row = await run_in_threadpool(_load_user, api_key)
+    if row is None:
+        return None
+    user = CachedUser(row.id, row.username, row.api_key, row.tenant_id)
+    _users.set(api_key, user)
+    return user
+
+
+def get_tenant_ids(names: Iterable[str]) -> Dict[str, int]:
+    """Resuelve nombres de tenant a ids; los que faltan en cache se buscan en una sola consulta."""
+    sync_invalidations()
+    ids, missing = {}, []
+    for name in set(names):
+        tenant_id = _tenant_ids.get(name)
+        if tenant_id is None:
+            missing.append(name)
+        else:
+            ids[name] = tenant_id
+    if missing:
+        db = get_admin_session()
+        try:
+            found = dict(db.query(Tenant.name, Tenant.id).filter(Tenant.name.in_(missing)).all())
+        finally:
+            db.close()
+        for name, tenant_id in found.items():
+            _tenant_ids.set(name, tenant_id)
+        ids.update(found)
+    return ids
+
+
+def get_tenant_id(tenant_name: str) -> Optional[int]:
+    return get_tenant_ids([tenant_name]).get(tenant_name)
+
+
+# ----------------------------------------
+# Invalidación (endpoints de administración)
+# ----------------------------------------
+
+def invalidate_user(api_key: str):
+    _users.invalidate(api_key)
+    _publish(["user", api_key])
+
+
+def invalidate_tenant(tenant_name: str):
+    """Olvida el id del tenant y los usuarios cacheados (pueden haber cambiado de tenant)."""
+    _tenant_ids.invalidate(tenant_name)
+    _users.clear()
+    _publish(["tenant", tenant_name])
+
+
+def invalidate_identity():
+    _users.clear()
+    _tenant_ids.clear()
+    _publish(["all"])
+
+
+def identity_cache_stats() -> dict:
+    return {
+        "users": _users.stats(),
+        "tenants": _tenant_ids.stats(),
+        "sync": {"enabled": bool(ADMIN_CACHE_SYNC_PATH), "offset": _sync_state["offset"]},
+    }
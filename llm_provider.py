@@ -0,0 +1,203 @@
+# llm_provider.py
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from langchain_core.rate_limiters import BaseRateLimiter
+
+from config import (
+    LLM_MODEL, GOOGLE_API_KEY, LLM_CACHE_ENABLED, LLM_CACHE_DISABLED_CHAINS,
+    LLM_TIMEOUT, LLM_MAX_RETRIES, LLM_MAX_CONCURRENCY, LLM_TENANT_RPM, LLM_TENANT_BURST,
+    LLM_MAX_WAIT,
+)
+from llm_cache import get_llm_cache
+from metrics import LLMMetricsHandler
+
+# Tenant de la request en curso; lo fija pipeline.tenant_slot y lo lee el rate limiter
+current_tenant: ContextVar[Optional[str]] = ContextVar("current_tenant", default=None)
+
+
+class LLMBusyError(Exception):
+    """El LLM está saturado para este tenant/proceso; el cliente debería reintentar."""
+
+
+class _TokenBucket:
+    def __init__(self, rate_per_sec: float, burst: int):
+        self.rate = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> float:
+        """Reserva un permiso y devuelve cuánto hay que esperar para usarlo."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if wait > max_wait:
+                raise LLMBusyError("Demasiadas consultas al LLM para este tenant, reintentá en unos segundos")
+            self.tokens -= 1
+            return wait
+
+
+class TenantRateLimiter(BaseRateLimiter):
+    """
+    Limita las llamadas al LLM por tenant (token bucket de LLM_TENANT_RPM).
+    LangChain lo invoca antes de cada llamada, incluidas las del agente SQL.
+    """
+
+    def __init__(self, requests_per_minute: float = LLM_TENANT_RPM, burst: int = LLM_TENANT_BURST,
+                 max_wait: float = LLM_MAX_WAIT):
+        self.rate = requests_per_minute / 60.0
+        self.burst = burst
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.rejected = 0
+
+    def _bucket(self, tenant: str) -> _TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(tenant)
+            if bucket is None:
+                bucket = self._buckets[tenant] = _TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def _reserve(self, blocking: bool) -> Optional[float]:
+        tenant = current_tenant.get()
+        if tenant is None or self.rate <= 0:
+            return 0.0
+        try:
+            wait = self._bucket(tenant).reserve(self.max_wait if blocking else 0.0)
+        except LLMBusyError:
+            self.rejected += 1
+            if not blocking:
+                return None
+            raise
+        if wait:
+            self.throttled += 1
+        return wait
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        wait = self._reserve(blocking)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        wait = self._reserve(blocking)
+        if wait is None:
+            return False
+        if wait:
+            await asyncio.sleep(wait)
+        return True
+
+
+rate_limiter = TenantRateLimiter()
+
+# Un único cliente (y su canal HTTP/gRPC con keep-alive) para todo el proceso.
+# Cada chain usa una copia superficial que comparte ese cliente y solo cambia
+# el cache y el callback de métricas.
+_shared_llm = None
+_variants = {}
+_llm_lock = threading.Lock()
+
+def _build_shared_llm():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model=LLM_MODEL,
+        temperature=0,
+        google_api_key=GOOGLE_API_KEY,
+        timeout=LLM_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        rate_limiter=rate_limiter,
+        cache=False,
+    )
+
+def get_llm(chain_name: str = None):
+    """
+    Devuelve el cliente LLM compartido. Usa el cache de respuestas salvo que esté
+    deshabilitado o la chain figure en LLM_CACHE_DISABLED_CHAINS.
+    """
+    global _shared_llm
+    use_cache = LLM_CACHE_ENABLED and chain_name not in LLM_CACHE_DISABLED_CHAINS
+    with _llm_lock:
+        if _shared_llm is None:
+            _shared_llm = _build_shared_llm()
+        llm = _variants.get(chain_name)
+        if llm is None:
+            llm = _shared_llm.model_copy(update={
+                "cache": get_llm_cache() if use_cache else False,
+                "callbacks": [LLMMetricsHandler(chain_name)],
+            })
+            _variants[chain_name] = llm
+        return llm
+
+# ----------------------------------------
+# Concurrencia de llamadas al LLM dentro del worker
+# ----------------------------------------
+
+_llm_semaphore = None
+_loop = None  # loop del worker donde vive el semáforo
+_waiting = 0
+
+@asynccontextmanager
+async def llm_slot():
+    """
+    Ocupa uno de los LLM_MAX_CONCURRENCY lugares para llamar al LLM.
+    Si no se libera uno en LLM_MAX_WAIT segundos, falla con LLMBusyError.
+    """
+    global _llm_semaphore, _loop, _waiting
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        _loop = asyncio.get_running_loop()
+    _waiting += 1
+    try:
+        await asyncio.wait_for(_llm_semaphore.acquire(), timeout=LLM_MAX_WAIT)
+    except asyncio.TimeoutError:
+        raise LLMBusyError("El servicio está saturado, reintentá en unos segundos")
+    finally:
+        _waiting -= 1
+    try:
+        yield
+    finally:
+        _llm_semaphore.release()
+
+def run_in_llm_slot(make_call):
+    """
+    Para hilos fuera del event loop (p.ej. la compactación de memoria): corre la
+    corrutina make_call() en el loop del worker dentro de llm_slot, con el tenant
+    del hilo para el rate limiter, y espera el resultado. No llamar desde el loop.
+    Si todavía no hay loop (scripts sin requests) la corre sin slot.
+    """
+    tenant = current_tenant.get()
+    loop = _loop
+    in_slot = loop is not None and not loop.is_closed()
+
+    async def call():
+        current_tenant.set(tenant)
+        if not in_slot:
+            return await make_call()
+        async with llm_slot():
+            return await make_call()
+
+    if not in_slot:
+        return asyncio.run(call())
+    return asyncio.run_coroutine_threadsafe(call(), loop).result()
+
+def llm_provider_stats() -> dict:
+    in_use = LLM_MAX_CONCURRENCY - _llm_semaphore._value if _llm_semaphore is not None else 0
+    return {
+        "max_concurrency": LLM_MAX_CONCURRENCY,
+        "in_use": in_use,
+        "waiting": _waiting,
+        "throttled": rate_limiter.throttled,
+        "rejected": rate_limiter.rejected,
+    }
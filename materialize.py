@@ -0,0 +1,183 @@
+# materialize.py
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+from cache import LRUCache
+from config import (
+    MATERIALIZE_ENABLED, MATERIALIZE_MIN_HITS, MATERIALIZE_MIN_MS, MATERIALIZE_MAX_ROWS,
+    MATERIALIZE_MAX_TABLES, MATERIALIZE_TRACK_MAX,
+)
+from db import data_fingerprint, get_engine_for_path, sqlite_file_path
+
+
+def normalize_sql(sql: str) -> str:
+    """Misma SQL con distinto espaciado o ';' final => misma clave (los literales no se tocan)."""
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+
+
+def sql_key(sql: str) -> str:
+    return hashlib.sha1(normalize_sql(sql).encode("utf-8")).hexdigest()[:16]
+
+
+MATERIALIZED_SUFFIX = ".mat.sqlite"
+
+
+def sidecar_path(db_path: str) -> str:
+    """Archivo SQLite con las materializaciones, al lado de la base del tenant."""
+    return sqlite_file_path(db_path) + MATERIALIZED_SUFFIX
+
+
+class SQLStats:
+    __slots__ = ("sql", "count", "total_ms", "last_ms")
+
+    def __init__(self, sql: str):
+        self.sql = normalize_sql(sql)
+        self.count = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+
+class Materialization(NamedTuple):
+    table: str
+    fingerprint: tuple
+    rows: int
+
+
+# (db_path, key) -> SQLStats de la SQL final ejecutada
+_stats = LRUCache(maxsize=MATERIALIZE_TRACK_MAX)
+# (db_path, key) -> Materialization vigente en el sidecar
+_materialized = {}
+_pending = set()
+_lock = threading.Lock()
+_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="materialize")
+_counters = {"served": 0, "built": 0, "refreshed": 0, "skipped_large": 0, "errors": 0}
+
+
+def record_execution(db_path: str, sql: str, elapsed_ms: float):
+    """
+    Registra frecuencia y latencia de la SQL. Las que son frecuentes y caras se
+    materializan en segundo plano.
+    """
+    if not MATERIALIZE_ENABLED:
+        return
+    key = (db_path, sql_key(sql))
+    stats = _stats.get_or_create(key, lambda: SQLStats(sql))
+    with _lock:
+        stats.count += 1
+        stats.total_ms += elapsed_ms
+        stats.last_ms = elapsed_ms
+        promote = (
+            stats.count >= MATERIALIZE_MIN_HITS
+            and stats.avg_ms >= MATERIALIZE_MIN_MS
+            and key not in _materialized
+            and key not in _pending
+        )
+        if promote:
+            _pending.add(key)
+    if promote:
+        _worker.submit(_build, db_path, key[1], stats.sql)
+
+
+def _build(db_path: str, key: str, sql: str):
+    """Crea (o recrea) la tabla materializada de la SQL en el sidecar."""
+    table = f"mv_{key}"
+    fingerprint = data_fingerprint(db_path)
+    source = os.path.abspath(sqlite_file_path(db_path))
+    refreshing = (db_path, key) in _materialized
+    try:
+        conn = sqlite3.connect(sidecar_path(db_path), isolation_level=None, uri=True)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # La base del tenant se adjunta en solo lectura
+            conn.execute("ATTACH DATABASE ? AS src", (f"file:{source}?mode=ro",))
+            # Los nombres sin calificar se resuelven en src: el sidecar solo tiene tablas mv_*
+            conn.execute("BEGIN")
+            conn.execute(f'DROP TABLE IF EXISTS "{table}_new"')
+            conn.execute(f'CREATE TABLE "{table}_new" AS {sql}')
+            (rows,) = conn.execute(f'SELECT COUNT(*) FROM "{table}_new"').fetchone()
+            if rows > MATERIALIZE_MAX_ROWS:
+                conn.execute("ROLLBACK")
+                with _lock:
+                    _counters["skipped_large"] += 1
+                return
+            conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+            conn.execute(f'ALTER TABLE "{table}_new" RENAME TO "{table}"')
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        # Si los datos cambiaron mientras se construía, la huella no coincide y se refresca de nuevo
+        with _lock:
+            _materialized[(db_path, key)] = Materialization(table, fingerprint, rows)
+            _counters["refreshed" if refreshing else "built"] += 1
+        _evict_excess(db_path)
+    except Exception as e:
+        print(f"Error materializando {key} de {db_path}: {e}")
+        with _lock:
+            _counters["errors"] += 1
+    finally:
+        with _lock:
+            _pending.discard((db_path, key))
+
+
+def _evict_excess(db_path: str):
+    """Deja como máximo MATERIALIZE_MAX_TABLES materializaciones por base (las más usadas)."""
+    with _lock:
+        keys = [k for k in _materialized if k[0] == db_path]
+        if len(keys) <= MATERIALIZE_MAX_TABLES:
+            return
+        def uses(k):
+            stats = _stats.get(k)
+            return stats.count if stats else 0
+        keys.sort(key=uses)
+        dropped = [(k, _materialized.pop(k)) for k in keys[:len(keys) - MATERIALIZE_MAX_TABLES]]
+    conn = sqlite3.connect(sidecar_path(db_path), isolation_level=None)
+    try:
+        for _, mat in dropped:
+            conn.execute(f'DROP TABLE IF EXISTS "{mat.table}"')
+    finally:
+        conn.close()
+
+
+def materialized_source(db_path: str, sql: str) -> Optional[tuple]:
+    """
+    Si la SQL tiene una materialización vigente devuelve (engine del sidecar, SQL
+    equivalente). Si está desactualizada agenda el refresco y devuelve None.
+    """
+    if not MATERIALIZE_ENABLED:
+        return None
+    key = sql_key(sql)
+    with _lock:
+        mat = _materialized.get((db_path, key))
+    if mat is None:
+        return None
+    if mat.fingerprint != data_fingerprint(db_path):
+        with _lock:
+            schedule = (db_path, key) not in _pending
+            if schedule:
+                _pending.add((db_path, key))
+        if schedule:
+            _worker.submit(_build, db_path, key, normalize_sql(sql))
+        return None
+    with _lock:
+        _counters["served"] += 1
+    # ORDER BY rowid conserva el orden en que la SQL original devolvió las filas
+    return get_engine_for_path(sidecar_path(db_path)), f'SELECT * FROM "{mat.table}" ORDER BY rowid'
+
+
+def materialize_stats() -> dict:
+    with _lock:
+        return {
+            "tracked": len(_stats),
+            "materialized": len(_materialized),
+            "pending": len(_pending),
+            **_counters,
+        }
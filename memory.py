@@ -1,49 +1,459 @@
-from models import ChatMessage, Tenant
+import atexit
+import datetime
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
+from models import ChatMessage, ConversationSummary
 from db import get_admin_session
-from config import MAX_TOKENS_CONTEXT
+from identity import get_tenant_id, get_tenant_ids
+from cache import LRUCache
+from tokens import count_tokens
+from llm_provider import current_tenant, run_in_llm_slot
+from chains import resumidor
+from config import (
+    MAX_TOKENS_CONTEXT, MEMORY_CACHE_USERS, MEMORY_CACHE_TTL, MEMORY_SCAN_BATCH,
+    MEMORY_WRITE_BEHIND, MEMORY_WRITE_BATCH, MEMORY_WRITE_INTERVAL, MEMORY_FLUSH_TIMEOUT,
+    MEMORY_SUMMARY_ENABLED, MEMORY_SUMMARY_TRIGGER_TOKENS, MEMORY_RECENT_TOKENS, MEMORY_SUMMARY_WORDS,
+    MEMORY_SUMMARY_CHUNK_TOKENS, MEMORY_SUMMARY_TURN_TOKENS,
+)
 
-# Guarda un mensaje sin eliminar los anteriores
-def add_message(tenant_name: str, user_id: str, role: str, content: str):
-    db = get_admin_session()
-    tenant = db.query(Tenant).filter_by(name=tenant_name).first()
-    tenant_id = tenant.id if tenant else None
+# Rol con el que el resumen acumulado aparece al principio de la ventana de contexto
+SUMMARY_ROLE = "conversation_summary"
+
+
+class TurnBuffer:
+    """
+    Últimos turnos de un usuario (role, content, tokens) con el total de tokens
+    acumulado. Se recorta por la izquierda para no superar max_tokens.
+    summary es (texto, tokens) del resumen de los turnos anteriores, si existe.
+    """
+
+    def __init__(self, max_tokens: int, turns=(), summary=None):
+        self.max_tokens = max_tokens
+        self.summary = summary
+        self.turns = deque()
+        self.total_tokens = 0
+        for role, content, tokens in turns:
+            self.append(role, content, tokens)
+
+    def append(self, role: str, content: str, tokens: int):
+        self.turns.append((role, content, tokens))
+        self.total_tokens += tokens
+        while self.total_tokens > self.max_tokens and len(self.turns) > 1:
+            _, _, dropped = self.turns.popleft()
+            self.total_tokens -= dropped
+
+    def window(self, max_tokens: int):
+        """
+        Resumen (si entra) y turnos más recientes que entran en max_tokens, en orden
+        cronológico. El resumen tiene prioridad sobre los turnos más viejos.
+        """
+        context = []
+        total = 0
+        with_summary = self.summary is not None and self.summary[1] <= max_tokens
+        if with_summary:
+            total = self.summary[1]
+        for role, content, tokens in reversed(self.turns):
+            if total + tokens > max_tokens:
+                break
+            context.append((role, content))
+            total += tokens
+        if with_summary:
+            context.append((SUMMARY_ROLE, self.summary[0]))
+        context.reverse()
+        return context
+
+
+# (tenant_name, user_id) -> TurnBuffer
+_buffers = LRUCache(maxsize=MEMORY_CACHE_USERS, ttl=MEMORY_CACHE_TTL)
+# Locks por usuario (repartidos en franjas) para que una carga desde la base
+# y una escritura concurrente no dejen el buffer desactualizado
+_buffer_locks = [threading.Lock() for _ in range(64)]
+
+def _buffer_lock(key):
+    return _buffer_locks[hash(key) % len(_buffer_locks)]
+
+class MessageWriter:
+    """
+    Escritura diferida de mensajes: add_message encola y un hilo en segundo
+    plano inserta los mensajes acumulados en una sola transacción.
+    """
+
+    def __init__(self, batch_size: int = MEMORY_WRITE_BATCH, interval: float = MEMORY_WRITE_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
 
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+                self._thread.start()
+
+    def put(self, message: dict):
+        self._ensure_started()
+        self._queue.put(message)
+
+    def pending(self) -> int:
+        return self._queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Junta lo que llegue durante `interval` hasta completar el lote
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch, retries: int = 3):
+        for attempt in range(retries):
+            db = get_admin_session()
+            try:
+                tenant_ids = get_tenant_ids(m["tenant_name"] for m in batch)
+                db.bulk_insert_mappings(ChatMessage, [
+                    {
+                        "tenant_id": tenant_ids.get(m["tenant_name"]),
+                        "user_id": m["user_id"],
+                        "role": m["role"],
+                        "content": m["content"],
+                        "token_count": m["token_count"],
+                        "timestamp": m["timestamp"],
+                    }
+                    for m in batch
+                ])
+                db.commit()
+                self.written += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                db.rollback()
+                print(f"Error guardando {len(batch)} mensajes (intento {attempt + 1}): {e}")
+                time.sleep(0.5 * (attempt + 1))
+            finally:
+                db.close()
+        self.failed += len(batch)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Espera a que se escriban los mensajes encolados. Devuelve False si vence el timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
+
+
+_writer = MessageWriter()
+
+def flush_messages(timeout: float = 10.0):
+    """Hook de apagado: persiste los mensajes pendientes."""
+    if not _writer.flush(timeout):
+        print(f"Quedaron {_writer.pending()} mensajes sin guardar al apagar")
+
+atexit.register(flush_messages)
+
+def _write_message(tenant_name: str, user_id: str, role: str, content: str, tokens: int):
+    tenant_id = get_tenant_id(tenant_name)
+    db = get_admin_session()
     db.add(ChatMessage(
         tenant_id=tenant_id,
         user_id=user_id,
         role=role,
-        content=content
+        content=content,
+        token_count=tokens
     ))
     db.commit()
     db.close()
 
-# Carga todos los mensajes para un usuario en una sesión
-def load_memory(tenant_name: str, user_id: str):
+# Guarda un mensaje sin eliminar los anteriores. Puede bloquear (lock del buffer,
+# escritura directa sin write-behind): desde código async va por el threadpool.
+def add_message(tenant_name: str, user_id: str, role: str, content: str):
+    # Los tokens se cuentan una sola vez, al guardar
+    tokens = count_tokens(content)
+
+    if not MEMORY_WRITE_BEHIND:
+        _write_message(tenant_name, user_id, role, content, tokens)
+
+    key = (tenant_name, user_id)
+    with _buffer_lock(key):
+        buffer = _buffers.get(key)
+        if buffer is not None:
+            buffer.append(role, content, tokens)
+            _maybe_compact(tenant_name, user_id, buffer)
+        if MEMORY_WRITE_BEHIND:
+            # Se encola bajo el lock: una carga concurrente del buffer hace
+            # flush antes de leer, así que nunca pierde este mensaje
+            _writer.put({
+                "tenant_name": tenant_name,
+                "user_id": user_id,
+                "role": role,
+                "content": content,
+                "token_count": tokens,
+                "timestamp": datetime.datetime.utcnow(),
+            })
+
+# Recorre los mensajes del más nuevo al más viejo (índice tenant/user/timestamp)
+# y se detiene apenas se llena el presupuesto de tokens
+def load_recent_turns(tenant_name: str, user_id: str, max_tokens: int, after_id: int = 0):
+    tenant_id = get_tenant_id(tenant_name)
+    if tenant_id is None:
+        return []
     db = get_admin_session()
-    msgs = (
-        db.query(ChatMessage)
-          .filter_by(tenant_id=db.query(Tenant).filter_by(name=tenant_name).first().id,
-                     user_id=user_id)
-          .order_by(ChatMessage.timestamp.asc())
-          .all()
-    )
-    db.close()
-    return [(m.role, m.content) for m in msgs]
+    try:
+        query = (
+            db.query(ChatMessage.role, ChatMessage.content, ChatMessage.token_count)
+              .filter(ChatMessage.tenant_id == tenant_id, ChatMessage.user_id == user_id,
+                      ChatMessage.id > after_id)
+              .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+              .yield_per(MEMORY_SCAN_BATCH)
+        )
+        turns = []
+        total_tokens = 0
+        for role, content, tokens in query:
+            if tokens is None:
+                # Mensajes guardados antes de existir token_count
+                tokens = count_tokens(content)
+            if total_tokens + tokens > max_tokens:
+                break
+            turns.append((role, content, tokens))
+            total_tokens += tokens
+    finally:
+        db.close()
+    turns.reverse()
+    return turns
+
+_flush_timeouts = Counter()
+
+def _get_buffer(tenant_name: str, user_id: str) -> TurnBuffer:
+    key = (tenant_name, user_id)
+    buffer = _buffers.get(key)
+    if buffer is not None:
+        return buffer
+    with _buffer_lock(key):
+        buffer = _buffers.get(key)
+        if buffer is None:
+            # Read-your-writes: lo encolado tiene que estar en la base antes de leer.
+            # Con el writer trabado no se espera indefinidamente: el buffer se arma
+            # con lo que haya en la base y no se cachea (el próximo acceso reintenta)
+            flushed = _writer.flush(MEMORY_FLUSH_TIMEOUT)
+            summary = load_summary(tenant_name, user_id)
+            turns = load_recent_turns(
+                tenant_name, user_id, MAX_TOKENS_CONTEXT, summary.covered_until_id if summary else 0
+            )
+            buffer = TurnBuffer(
+                MAX_TOKENS_CONTEXT, turns, (summary.summary, summary.token_count) if summary else None
+            )
+            if not flushed:
+                _flush_timeouts["count"] += 1
+                return buffer
+            _buffers.set(key, buffer)
+            _maybe_compact(tenant_name, user_id, buffer)
+    return buffer
+
+def has_history(tenant_name: str, user_id: str) -> bool:
+    """True si el usuario tiene turnos previos o un resumen de la conversación."""
+    buffer = _get_buffer(tenant_name, user_id)
+    return buffer.summary is not None or bool(buffer.turns)
 
 # Ventana contextual basada en tokens
 def get_context_window(tenant_name: str, user_id: str, max_tokens=MAX_TOKENS_CONTEXT):
-    messages = load_memory(tenant_name, user_id)
-    total_tokens = 0
-    context = []
+    if max_tokens > MAX_TOKENS_CONTEXT:
+        # El buffer solo cubre MAX_TOKENS_CONTEXT, se lee directo de la base
+        _writer.flush(MEMORY_FLUSH_TIMEOUT)
+        summary = load_summary(tenant_name, user_id)
+        turns = load_recent_turns(tenant_name, user_id, max_tokens, summary.covered_until_id if summary else 0)
+        return TurnBuffer(
+            max_tokens, turns, (summary.summary, summary.token_count) if summary else None
+        ).window(max_tokens)
+
+    buffer = _get_buffer(tenant_name, user_id)
+    key = (tenant_name, user_id)
+    with _buffer_lock(key):
+        return buffer.window(max_tokens)
+
+# ----------------------------------------
+# Resumen acumulado (compactación en segundo plano)
+# ----------------------------------------
+
+_compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-compactor")
+_compacting = set()
+_compacting_lock = threading.Lock()
+# Usuarios cuya última compactación falló: no se reintenta hasta que vence la entrada
+_compaction_backoff = LRUCache(maxsize=MEMORY_CACHE_USERS, ttl=60)
+_compaction_stats = Counter()
+
+def load_summary(tenant_name: str, user_id: str):
+    tenant_id = get_tenant_id(tenant_name)
+    db = get_admin_session()
+    try:
+        return db.query(ConversationSummary).filter_by(tenant_id=tenant_id, user_id=user_id).first()
+    finally:
+        db.close()
+
+def _save_summary(tenant_id, user_id, summary: str, covered_until_id: int):
+    db = get_admin_session()
+    try:
+        row = db.query(ConversationSummary).filter_by(tenant_id=tenant_id, user_id=user_id).first()
+        if row is None:
+            db.add(ConversationSummary(
+                tenant_id=tenant_id, user_id=user_id, summary=summary,
+                token_count=count_tokens(summary), covered_until_id=covered_until_id,
+            ))
+        elif row.covered_until_id < covered_until_id:
+            row.summary = summary
+            row.token_count = count_tokens(summary)
+            row.covered_until_id = covered_until_id
+        else:
+            # Otro worker ya resumió hasta acá
+            return
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+    finally:
+        db.close()
+
+def _maybe_compact(tenant_name: str, user_id: str, buffer: TurnBuffer):
+    """Agenda la compactación si los turnos sin resumir superan el umbral."""
+    if not MEMORY_SUMMARY_ENABLED or buffer.total_tokens <= MEMORY_SUMMARY_TRIGGER_TOKENS:
+        return
+    key = (tenant_name, user_id)
+    if key in _compaction_backoff:
+        return
+    with _compacting_lock:
+        if key in _compacting:
+            return
+        _compacting.add(key)
+    _compactor.submit(_run_compaction, tenant_name, user_id)
+
+def _run_compaction(tenant_name: str, user_id: str):
+    key = (tenant_name, user_id)
+    try:
+        compact_memory(tenant_name, user_id)
+    except Exception as e:
+        print(f"Error resumiendo la conversación de {tenant_name}/{user_id}: {e}")
+        _compaction_stats["failed"] += 1
+        _compaction_backoff.set(key, True)
+    finally:
+        with _compacting_lock:
+            _compacting.discard(key)
+
+def _truncate(content: str, max_tokens: int) -> str:
+    """Recorta turnos muy largos (p.ej. resultados de consultas) antes de resumirlos."""
+    if count_tokens(content) <= max_tokens:
+        return content
+    return content[:max_tokens * 4] + " [...]"
+
+def _summarize(previous: str, lines) -> str:
+    # Comparte llm_slot y el rate limiter del tenant con las requests
+    return run_in_llm_slot(lambda: resumidor.get_chain().apredict(
+        resumen_previo=previous or "(vacío)",
+        turnos="\n".join(lines),
+        max_palabras=MEMORY_SUMMARY_WORDS,
+    )).strip()
+
+def compact_memory(tenant_name: str, user_id: str) -> bool:
+    """
+    Pliega los turnos sin resumir más viejos en el resumen del usuario y deja
+    textuales los últimos MEMORY_RECENT_TOKENS. Devuelve True si actualizó el resumen.
+    """
+    token = current_tenant.set(tenant_name)
+    try:
+        _writer.flush()
+        tenant_id = get_tenant_id(tenant_name)
+        summary = load_summary(tenant_name, user_id)
+        covered = summary.covered_until_id if summary else 0
+
+        # Turnos sin resumir, del más nuevo al más viejo, hasta MAX_TOKENS_CONTEXT
+        # (lo anterior nunca entraría en la ventana y se da por cubierto)
+        rows, total = [], 0
+        db = get_admin_session()
+        try:
+            query = (
+                db.query(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.token_count)
+                  .filter(ChatMessage.tenant_id == tenant_id, ChatMessage.user_id == user_id,
+                          ChatMessage.id > covered)
+                  .order_by(ChatMessage.id.desc())
+                  .yield_per(MEMORY_SCAN_BATCH)
+            )
+            for msg_id, role, content, tokens in query:
+                tokens = tokens if tokens is not None else count_tokens(content)
+                if total + tokens > MAX_TOKENS_CONTEXT:
+                    break
+                rows.append((msg_id, role, content, tokens))
+                total += tokens
+        finally:
+            db.close()
+        if total <= MEMORY_SUMMARY_TRIGGER_TOKENS:
+            return False
+        rows.reverse()
+
+        # Los turnos más recientes quedan textuales
+        keep, kept = len(rows), 0
+        while keep > 0 and kept + rows[keep - 1][3] <= MEMORY_RECENT_TOKENS:
+            keep -= 1
+            kept += rows[keep][3]
+        fold = rows[:keep]
+        if not fold:
+            return False
+
+        text = summary.summary if summary else ""
+        chunk, chunk_tokens = [], 0
+        for _, role, content, tokens in fold:
+            line = f"{role}: {_truncate(content, MEMORY_SUMMARY_TURN_TOKENS)}"
+            line_tokens = min(tokens, MEMORY_SUMMARY_TURN_TOKENS)
+            if chunk and chunk_tokens + line_tokens > MEMORY_SUMMARY_CHUNK_TOKENS:
+                text = _summarize(text, chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append(line)
+            chunk_tokens += line_tokens
+        text = _summarize(text, chunk)
 
-    def estimate_tokens(text):
-        return len(text.split())
+        _save_summary(tenant_id, user_id, text, fold[-1][0])
+        # El próximo acceso recarga el buffer como resumen + turnos recientes
+        _buffers.invalidate((tenant_name, user_id))
+        _compaction_stats["runs"] += 1
+        _compaction_stats["folded_turns"] += len(fold)
+        _compaction_stats["folded_tokens"] += sum(r[3] for r in fold)
+        return True
+    finally:
+        current_tenant.reset(token)
 
-    for role, content in reversed(messages):
-        tokens = estimate_tokens(content)
-        if total_tokens + tokens > max_tokens:
-            break
-        context.insert(0, (role, content))
-        total_tokens += tokens
+def invalidate_buffers(tenant_name: str) -> int:
+    """Descarta los buffers en memoria de los usuarios del tenant (p.ej. tras archivar mensajes)."""
+    return _buffers.invalidate_where(lambda key: key[0] == tenant_name)
 
-    return context
\ No newline at end of file
+def memory_cache_stats() -> dict:
+    return {
+        "buffers": _buffers.stats(),
+        "writer": {**_writer.stats(), "flush_timeouts": _flush_timeouts["count"]},
+        "summaries": {**_compaction_stats, "pending": len(_compacting)},
+    }
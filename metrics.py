@@ -0,0 +1,293 @@
+# metrics.py
+import bisect
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from config import METRICS_ENABLED, METRICS_TRACE_SAMPLE, METRICS_TRACE_PATH
+
+# ----------------------------------------
+# Métricas en formato Prometheus (sin dependencias externas)
+# ----------------------------------------
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROW_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [conteo por bucket (no acumulado), suma, total]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        names = self.labelnames + ("le",)
+        for key, (counts, total_sum, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(names, key + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {total}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total_sum}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {total}"
+
+
+stage_seconds = Histogram(
+    "sql_agent_stage_seconds", "Duración de cada etapa de /query y /feedback", ("endpoint", "stage")
+)
+request_seconds = Histogram(
+    "sql_agent_request_seconds", "Duración total de /query y /feedback", ("endpoint", "status")
+)
+llm_calls = Counter("sql_agent_llm_calls_total", "Llamadas al LLM por chain", ("chain",))
+llm_errors = Counter("sql_agent_llm_errors_total", "Llamadas al LLM fallidas por chain", ("chain",))
+llm_tokens = Counter("sql_agent_llm_tokens_total", "Tokens de entrada/salida por chain", ("chain", "direction"))
+llm_seconds = Histogram("sql_agent_llm_seconds", "Latencia de cada llamada al LLM", ("chain",))
+sql_seconds = Histogram(
+    "sql_agent_sql_seconds", "Tiempo de ejecución de SQL por tenant", ("tenant", "source")
+)
+sql_rows = Histogram("sql_agent_sql_rows", "Filas leídas por SQL por tenant", ("tenant",), ROW_BUCKETS)
+sql_budget_exceeded = Counter(
+    "sql_agent_sql_budget_exceeded_total", "SQL cortadas o rechazadas por el presupuesto del tenant",
+    ("tenant", "reason"),
+)
+admin_db_queries = Counter("sql_agent_admin_db_queries_total", "Sentencias ejecutadas contra el admin DB")
+
+
+def _stats_lines(stats: dict):
+    """Exporta los *_stats existentes como gauges sql_agent_stats{section, name}."""
+    yield "# HELP sql_agent_stats Contadores internos de caches y pools (ver /admin/stats)"
+    yield "# TYPE sql_agent_stats gauge"
+
+    def flatten(prefix, value):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                yield from flatten(f"{prefix}_{k}" if prefix else str(k), v)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix, value
+
+    for section, values in stats.items():
+        for name, value in flatten("", values):
+            yield f"sql_agent_stats{_format_labels(('section', 'name'), (section, name))} {value}"
+
+
+def render_metrics(stats: Optional[dict] = None) -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    if stats:
+        lines.extend(_stats_lines(stats))
+    return "\n".join(lines) + "\n"
+
+# ----------------------------------------
+# Spans por etapa y traza muestreada
+# ----------------------------------------
+
+class Trace:
+    def __init__(self, endpoint: str, tenant: str, sampled: bool):
+        self.endpoint = endpoint
+        self.tenant = tenant
+        self.sampled = sampled
+        self.status = "success"
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, kind: str, name: str, seconds: float, **extra):
+        if self.sampled:
+            self.spans.append({
+                "kind": kind, "name": name,
+                "start_ms": round((time.perf_counter() - self.started - seconds) * 1000, 2),
+                "ms": round(seconds * 1000, 2), **extra,
+            })
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_trace_lock = threading.Lock()
+
+
+def _write_trace(trace: Trace, seconds: float):
+    record = {
+        "ts": time.time(), "endpoint": trace.endpoint, "tenant": trace.tenant,
+        "status": trace.status, "ms": round(seconds * 1000, 2), "spans": trace.spans,
+    }
+    try:
+        with _trace_lock, open(METRICS_TRACE_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except OSError as e:
+        print(f"Error guardando traza: {e}")
+
+
+@contextmanager
+def trace_request(endpoint: str, tenant: str):
+    """
+    Mide un request completo. Una fracción METRICS_TRACE_SAMPLE de los requests
+    se guarda con todas sus etapas en METRICS_TRACE_PATH (una línea JSON por request).
+    """
+    trace = Trace(endpoint, tenant, METRICS_TRACE_SAMPLE > 0 and random.random() < METRICS_TRACE_SAMPLE)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except Exception:
+        trace.status = "error"
+        raise
+    except BaseException:
+        # Cancelación o cliente desconectado en medio del stream
+        trace.status = "cancelled"
+        raise
+    finally:
+        seconds = time.perf_counter() - trace.started
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # Generador async cerrado desde otro contexto (cliente desconectado)
+            pass
+        request_seconds.observe(seconds, endpoint=endpoint, status=trace.status)
+        if trace.sampled:
+            _write_trace(trace, seconds)
+
+
+def set_trace_status(status: str):
+    """Resultado del request en curso para sql_agent_request_seconds (success, cached, clarification...)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.status = status
+
+
+@contextmanager
+def span(stage: str):
+    """Mide una etapa del request en curso (sirve alrededor de código async)."""
+    trace = _current_trace.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        stage_seconds.observe(seconds, endpoint=trace.endpoint if trace else "", stage=stage)
+        if trace is not None:
+            trace.add("stage", stage, seconds)
+
+
+def record_sql(tenant: Optional[str], seconds: float, rows: int, source: str = "base"):
+    sql_seconds.observe(seconds, tenant=tenant or "", source=source)
+    sql_rows.observe(rows, tenant=tenant or "")
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add("sql", source, seconds, rows=rows)
+
+# ----------------------------------------
+# Callback de LangChain para las llamadas al LLM
+# ----------------------------------------
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Cuenta llamadas, tokens y latencia de cada llamada al LLM de una chain."""
+
+    run_inline = True
+
+    def __init__(self, chain_name: str):
+        self.chain_name = chain_name or "default"
+        self._started = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        seconds = time.perf_counter() - started if started is not None else 0.0
+        tokens_in, tokens_out = _token_usage(response)
+        llm_calls.inc(chain=self.chain_name)
+        llm_seconds.observe(seconds, chain=self.chain_name)
+        if tokens_in:
+            llm_tokens.inc(tokens_in, chain=self.chain_name, direction="in")
+        if tokens_out:
+            llm_tokens.inc(tokens_out, chain=self.chain_name, direction="out")
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add("llm", self.chain_name, seconds, tokens_in=tokens_in, tokens_out=tokens_out)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._started.pop(run_id, None)
+        llm_errors.inc(chain=self.chain_name)
+
+
+def _token_usage(response) -> Tuple[int, int]:
+    """Tokens (entrada, salida) según usage_metadata del mensaje o llm_output del proveedor."""
+    tokens_in = tokens_out = 0
+    for generations in response.generations or []:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                tokens_in += usage.get("input_tokens", 0)
+                tokens_out += usage.get("output_tokens", 0)
+    if not (tokens_in or tokens_out):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        tokens_in = usage.get("prompt_tokens", 0)
+        tokens_out = usage.get("completion_tokens", 0)
+    return tokens_in, tokens_out
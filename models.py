@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, UniqueConstraint, Index, JSON
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
 from sqlalchemy.dialects.postgresql import JSONB
@@ -24,7 +24,8 @@ class TenantDatabase(Base):
     tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
     base_name = Column(String, nullable=False)
     db_path = Column(String, nullable=False)
-    schema_info = Column(JSONB, nullable=True)
+    # JSONB en Postgres; JSON en SQLite (admin DB local, benchmark)
+    schema_info = Column(JSONB().with_variant(JSON(), "sqlite"), nullable=True)
     __table_args__ = (UniqueConstraint('tenant_id', 'base_name', name='_tenant_base_uc'),)
 
 class ChatMessage(Base):
@@ -34,4 +35,27 @@ class ChatMessage(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     role = Column(String, nullable=False)
     content = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
\ No newline at end of file
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    token_count = Column(Integer, nullable=True)
+    # La ventana de contexto recorre los mensajes de un usuario del más nuevo al más viejo
+    __table_args__ = (Index('ix_chat_tenant_user_ts', 'tenant_id', 'user_id', 'timestamp'),)
+
+class ConversationSummary(Base):
+    """Resumen acumulado de los mensajes de un usuario hasta covered_until_id (inclusive)."""
+    __tablename__ = "conversation_summaries"
+    id = Column(Integer, primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    summary = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=False)
+    covered_until_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    __table_args__ = (UniqueConstraint('tenant_id', 'user_id', name='_summary_tenant_user_uc'),)
+class ExecutedQuery(Base):
+    __tablename__ = "executed_queries"
+    id = Column(String(32), primary_key=True)  # query_id que devuelve /query
+    tenant_name = Column(String, nullable=False)
+    base_name = Column(String, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    sql = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
@@ -0,0 +1,639 @@
+# pipeline.py
+import ast
+import asyncio
+import json
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from typing import List
+from starlette.concurrency import run_in_threadpool
+from langchain_core.callbacks import AsyncCallbackHandler
+
+from config import (
+    TENANT_MAX_CONCURRENCY, ANSWER_CACHE_ENABLED, SQL_MODE, SQL_MODE_BY_TENANT, SQL_REPAIR_MAX_ATTEMPTS,
+    SPECULATIVE_SQL, SPECULATIVE_SQL_BY_TENANT,
+)
+from db import get_tenant_db_path, get_tenant_engine, get_compiled_schema, data_fingerprint
+from executor import (
+    SQLValidationError, get_catalog, extract_sql, validate_sql, check_scan_budget, execute_sql, fuzzy_fix,
+    error_message, register_query,
+)
+from answer_cache import lookup_answer, store_answer, is_follow_up, skip_answer
+from metrics import span, trace_request, set_trace_status
+from llm_provider import current_tenant, llm_slot, LLMBusyError
+from tokens import context_budget, count_tokens
+from schema_index import select_tables, pruned_schema_text
+from memory import add_message, get_context_window, has_history
+from agent import get_sql_agent
+from chains import clarificador, explicador, clasificador, reformulador, corrector, generador
+
+SQL_MODES = ("agent", "fast")
+
+NO_CLARIFICATION = "NO_CLARIFICATION_NEEDED"
+
+# ----------------------------------------
+# Concurrencia por tenant
+# ----------------------------------------
+
+# Un tenant no puede ocupar más de TENANT_MAX_CONCURRENCY conversaciones a la vez
+_tenant_semaphores = defaultdict(lambda: asyncio.Semaphore(TENANT_MAX_CONCURRENCY))
+
+@asynccontextmanager
+async def tenant_slot(tenant_name: str):
+    async with _tenant_semaphores[tenant_name]:
+        # El rate limiter del LLM lee el tenant de este contexto
+        token = current_tenant.set(tenant_name)
+        try:
+            yield
+        finally:
+            current_tenant.reset(token)
+
+# ----------------------------------------
+# Etapas de /query
+# ----------------------------------------
+
+class SQLCaptureHandler(AsyncCallbackHandler):
+    """Guarda la última SQL que el agente mandó a ejecutar."""
+
+    def __init__(self):
+        self.last_sql = None
+
+    async def on_agent_action(self, action, **kwargs):
+        if action.tool == "sql_db_query":
+            self.last_sql = action.tool_input if isinstance(action.tool_input, str) else str(action.tool_input)
+
+def _add_messages(tenant_name: str, user_id: int, messages):
+    for role, content in messages:
+        add_message(tenant_name, user_id, role, content)
+
+async def save_messages(tenant_name: str, user_id: int, *messages):
+    """Guarda (role, content) en la conversación fuera del event loop (add_message puede bloquear)."""
+    await run_in_threadpool(_add_messages, tenant_name, user_id, messages)
+
+async def check_answer_cache(tenant_name: str, base_name: str, user_id: int, pregunta: str):
+    """
+    Devuelve (respuesta_cacheada | None, versiones) donde versiones es
+    (schema_version, data_version) tomadas antes de ejecutar la consulta, o
+    None si la respuesta no debe guardarse.
+    Se llama antes de guardar la pregunta. El cache es por (tenant, base), así
+    que solo se guardan respuestas calculadas sin historial previo; con
+    historial una pregunta que continúa la conversación ("¿y en 2013?")
+    tampoco se busca.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None, None
+    with span("answer_cache"):
+        history = await run_in_threadpool(has_history, tenant_name, user_id)
+        if history and is_follow_up(pregunta):
+            skip_answer("follow_up")
+            return None, None
+        schema = await run_in_threadpool(get_compiled_schema, tenant_name, base_name)
+        db_path = await run_in_threadpool(get_tenant_db_path, tenant_name, base_name)
+        versions = (schema.version, data_fingerprint(db_path))
+        cached = lookup_answer(tenant_name, base_name, pregunta, *versions)
+        if history:
+            # Lo que se calcule ahora puede depender de la conversación de este usuario
+            if cached is None:
+                skip_answer("history")
+            return cached, None
+        return cached, versions
+
+def remember_answer(tenant_name: str, base_name: str, pregunta: str, versions, sql, resultado, explic):
+    if versions is not None:
+        store_answer(tenant_name, base_name, pregunta, sql, resultado, explic, *versions)
+
+async def load_context(tenant_name: str, base_name: str, user_id: int, pregunta: str):
+    """
+    Devuelve (schema_text, context_text, tables) para la pregunta. El esquema trae
+    solo las tablas relevantes para la pregunta (tables) y sus vecinas por foreign key.
+    """
+    with span("load_context"):
+        schema = await run_in_threadpool(get_compiled_schema, tenant_name, base_name)
+        tables = await run_in_threadpool(select_tables, tenant_name, base_name, pregunta)
+        schema_text = await run_in_threadpool(pruned_schema_text, tenant_name, base_name, tables)
+        schema_tokens = schema.tokens if schema_text is schema.text else count_tokens(schema_text)
+        context = await run_in_threadpool(
+            get_context_window, tenant_name, user_id, context_budget(schema_tokens, pregunta)
+        )
+    context_text = "\n".join(f"{r}: {c}" for r, c in context) if context else ""
+    return schema_text, context_text, tables
+
+async def clarify(schema_text: str, context_text: str, pregunta: str) -> str:
+    with span("clarify"):
+        async with llm_slot():
+            clar = await clarificador.get_chain().arun({
+                "schema": schema_text,
+                "contexto": context_text,
+                "pregunta": pregunta
+            })
+    return clar.strip()
+
+def build_agent_input(context_text: str, schema_text: str, pregunta: str, clar: str) -> str:
+    return f"""Cuando tengas la respuesta final, respondé con:
+
+Final Answer: [tu respuesta]
+
+No agregues ningún otro texto fuera de ese formato.
+
+        Contexto previo:
+{context_text}
+
+Esquema de la base:
+{schema_text}
+
+Pregunta del usuario:
+{pregunta}
+
+Aclaraciones:
+{clar}
+"""
+
+# ----------------------------------------
+# Validación y reparación de SQL
+# ----------------------------------------
+
+_repair_stats = Counter()
+
+async def repair_sql(engine, catalog, sql: str, error: str, schema_text: str) -> str:
+    """
+    Repara una SQL inválida con un presupuesto de SQL_REPAIR_MAX_ATTEMPTS intentos.
+    Cada intento prueba primero un arreglo local de identificadores y, si no aplica,
+    manda a corrector_chain solo la SQL que falla y el error exacto.
+    """
+    with span("repair"):
+        return await _repair_sql(engine, catalog, sql, error, schema_text)
+
+async def _repair_sql(engine, catalog, sql: str, error: str, schema_text: str) -> str:
+    _repair_stats["attempts"] += 1
+    for _ in range(SQL_REPAIR_MAX_ATTEMPTS):
+        fixed = fuzzy_fix(sql, error, catalog)
+        source = "local"
+        if fixed is None:
+            source = "llm"
+            async with llm_slot():
+                raw_sql = await corrector.get_chain().arun({
+                    "schema": f"{catalog.ddl}\n\n{schema_text}",
+                    "query": sql,
+                    "error": error,
+                })
+            fixed = extract_sql(raw_sql)
+        try:
+            plan = await run_in_threadpool(validate_sql, engine, fixed)
+            # Una reparación que sigue recorriendo demasiadas filas vuelve al corrector
+            await run_in_threadpool(check_scan_budget, engine, plan, fixed)
+        except SQLValidationError as e:
+            _repair_stats[f"failed_{source}"] += 1
+            sql, error = fixed, str(e)
+            continue
+        _repair_stats[f"repaired_{source}"] += 1
+        return fixed
+
+    _repair_stats["exhausted"] += 1
+    raise SQLValidationError(f"No se pudo reparar la consulta: {error}")
+
+async def execute_cancellable(engine, sql: str) -> str:
+    """
+    execute_sql en el threadpool. Si el request se cancela (cliente desconectado o
+    especulación descartada) la consulta se interrumpe en SQLite en lugar de seguir
+    ocupando el hilo.
+    """
+    cancel = threading.Event()
+    try:
+        return await run_in_threadpool(execute_sql, engine, sql, cancel)
+    finally:
+        cancel.set()
+
+async def run_checked_sql(engine, catalog, sql: str, schema_text: str):
+    """
+    Valida localmente la SQL, la repara si hace falta y la ejecuta. Los cortes por
+    presupuesto (SQLBudgetExceeded) también pasan por el corrector con su mensaje.
+    Devuelve (resultado, sql ejecutada).
+    """
+    try:
+        with span("execute_sql"):
+            await run_in_threadpool(validate_sql, engine, sql)
+            return await execute_cancellable(engine, sql), sql
+    except LLMBusyError:
+        raise
+    except Exception as e:
+        sql = await repair_sql(engine, catalog, sql, error_message(e), schema_text)
+    with span("execute_sql"):
+        return await execute_cancellable(engine, sql), sql
+
+def repair_stats() -> dict:
+    return dict(_repair_stats)
+
+# ----------------------------------------
+# Ejecución
+# ----------------------------------------
+
+async def run_sql(tenant_name: str, base_name: str, schema_text: str, input_text: str, callbacks=None):
+    """
+    Ejecuta la pregunta con el agente SQL. Devuelve (resultado, última sql del agente).
+    Si el agente falla después de generar una SQL, esa SQL se valida, repara y
+    ejecuta directamente en lugar de repetir todo el ciclo del agente.
+    """
+    capture = SQLCaptureHandler()
+    sql_agent = None
+    try:
+        db_path = await run_in_threadpool(get_tenant_db_path, tenant_name, base_name)
+        # 🎯 Agente reutilizado desde el pool por tenant/base
+        sql_agent = await run_in_threadpool(get_sql_agent, db_path, tenant_name, base_name)
+        with span("agent"):
+            async with llm_slot():
+                resultado = await sql_agent.arun(
+                    {"input": input_text}, callbacks=[capture, *(callbacks or [])]
+                )
+        return resultado, capture.last_sql
+
+    except Exception as e:
+        if sql_agent is None or capture.last_sql is None or isinstance(e, LLMBusyError):
+            # No hay SQL con la cual recuperarse
+            raise
+        print(f"El agente falló ({e}), se recupera con su última SQL")
+        engine = await run_in_threadpool(get_tenant_engine, tenant_name, base_name)
+        catalog = await run_in_threadpool(get_catalog, engine)
+        return await run_checked_sql(engine, catalog, extract_sql(capture.last_sql), schema_text)
+
+def resolve_sql_mode(tenant_name: str, requested: str = None) -> str:
+    """Modo pedido en el request, si no el configurado para el tenant, si no el global."""
+    mode = requested or SQL_MODE_BY_TENANT.get(tenant_name) or SQL_MODE
+    if mode not in SQL_MODES:
+        raise ValueError(f"Modo de ejecución inválido: {mode}")
+    return mode
+
+async def run_fast_sql(tenant_name: str, base_name: str, schema_text: str, tables: List[str],
+                       context_text: str, pregunta: str, clar: str):
+    """
+    Camino rápido: una llamada al LLM genera la SQL a partir del esquema (con el DDL
+    de las tablas que eligió load_context), se valida localmente y se ejecuta directo
+    contra la base. Devuelve (resultado, sql).
+    """
+    engine = await run_in_threadpool(get_tenant_engine, tenant_name, base_name)
+    catalog = await run_in_threadpool(get_catalog, engine)
+    with span("generate_sql"):
+        async with llm_slot():
+            raw_sql = await generador.get_chain().arun({
+                "tablas": catalog.ddl_for(tables),
+                "schema": schema_text,
+                "contexto": context_text,
+                "pregunta": pregunta,
+                "aclaraciones": clar,
+            })
+    return await run_checked_sql(engine, catalog, extract_sql(raw_sql), schema_text)
+
+async def answer_sql(tenant_name: str, base_name: str, schema_text: str, tables: List[str],
+                     context_text: str, pregunta: str, clar: str, mode: str, callbacks=None):
+    """
+    Obtiene el resultado según el modo. En modo "fast" vuelve al agente ante
+    cualquier falla. Devuelve (resultado, sql ejecutada o None).
+    """
+    if mode == "fast":
+        try:
+            return await run_fast_sql(tenant_name, base_name, schema_text, tables, context_text, pregunta, clar)
+        except LLMBusyError:
+            raise
+        except Exception as e:
+            print(f"Camino rápido falló para {tenant_name}/{base_name}, se usa el agente: {e}")
+
+    input_text = build_agent_input(context_text, schema_text, pregunta, clar)
+    return await run_sql(tenant_name, base_name, schema_text, input_text, callbacks=callbacks)
+
+# ----------------------------------------
+# Clarificación y SQL en paralelo (especulación)
+# ----------------------------------------
+
+_speculation_stats = Counter()
+
+def speculation_enabled(tenant_name: str) -> bool:
+    return SPECULATIVE_SQL_BY_TENANT.get(tenant_name, SPECULATIVE_SQL)
+
+async def clarify_with_speculation(tenant_name: str, base_name: str, schema_text: str, tables: List[str],
+                                   context_text: str, pregunta: str, mode: str, callbacks=None):
+    """
+    Corre la clarificación y, si el tenant tiene la especulación activada, al mismo
+    tiempo la generación/ejecución de la SQL (con las aclaraciones vacías, que es
+    exactamente lo que recibiría si no hace falta aclarar).
+    Devuelve (clar, tarea de answer_sql o None). Si hace falta aclarar, la tarea
+    especulativa se cancela y se devuelve None.
+    """
+    if not speculation_enabled(tenant_name):
+        return await clarify(schema_text, context_text, pregunta), None
+
+    _speculation_stats["started"] += 1
+    started = time.perf_counter()
+    finished = []
+    task = asyncio.create_task(answer_sql(
+        tenant_name, base_name, schema_text, tables, context_text, pregunta, NO_CLARIFICATION, mode,
+        callbacks=callbacks,
+    ))
+    task.add_done_callback(lambda _: finished.append(time.perf_counter()))
+    try:
+        clar = await clarify(schema_text, context_text, pregunta)
+    except BaseException:
+        task.cancel()
+        raise
+    clarified = time.perf_counter()
+    # Tiempo en que la SQL corrió en paralelo con la clarificación
+    overlap_ms = ((finished[0] if finished else clarified) - started) * 1000
+
+    if clar != NO_CLARIFICATION:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        _speculation_stats["wasted"] += 1
+        _speculation_stats["wasted_ms"] += round(overlap_ms)
+        return clar, None
+
+    _speculation_stats["hits"] += 1
+    _speculation_stats["saved_ms"] += round(overlap_ms)
+    return clar, task
+
+def speculation_stats() -> dict:
+    return dict(_speculation_stats)
+
+async def explain(context_text: str, pregunta: str, schema_text: str, resultado: str) -> str:
+    with span("explain"):
+        async with llm_slot():
+            explic = await explicador.get_chain().arun({
+                "contexto": context_text,
+                "pregunta": pregunta,
+                "schema": schema_text,
+                "resultado": resultado
+            })
+    return explic.strip()
+
+async def run_query(tenant_name: str, base_name: str, user_id: int, pregunta: str,
+                    mode: str = None) -> dict:
+    """
+    Procesa una consulta SQL en lenguaje natural usando contexto persistente.
+    """
+    mode = resolve_sql_mode(tenant_name, mode)
+    with trace_request("query", tenant_name):
+        response = await _run_query(tenant_name, base_name, user_id, pregunta, mode)
+        set_trace_status("cached" if response.get("cached") else response["status"])
+        return response
+
+async def _run_query(tenant_name: str, base_name: str, user_id: int, pregunta: str, mode: str) -> dict:
+    async with tenant_slot(tenant_name):
+        # Respuesta ya calculada para la misma pregunta (o casi) sin cambios de esquema ni datos
+        cached, versions = await check_answer_cache(tenant_name, base_name, user_id, pregunta)
+
+        # Guardar pregunta original en la conversación
+        await save_messages(tenant_name, user_id, ("user", pregunta))
+        if cached is not None:
+            await save_messages(
+                tenant_name, user_id,
+                ("assistant_query_result", cached.result), ("assistant_explanation", cached.explanation),
+            )
+            response = {
+                "status": "success",
+                "result": cached.result,
+                "explicacion": cached.explanation,
+                "cached": True
+            }
+            if cached.sql:
+                # La SQL de la respuesta original se vuelve a registrar para /results y /export
+                response["query_id"] = register_query(tenant_name, base_name, user_id, extract_sql(cached.sql))
+            return response
+
+        # Cargar esquema semántico y contexto de conversación previa
+        schema_text, context_text, tables = await load_context(tenant_name, base_name, user_id, pregunta)
+
+        # Proceso de clarificación (con la SQL en paralelo si el tenant especula)
+        clar, sql_task = await clarify_with_speculation(
+            tenant_name, base_name, schema_text, tables, context_text, pregunta, mode
+        )
+        await save_messages(tenant_name, user_id, ("assistant_clarification", clar))
+
+        if clar != NO_CLARIFICATION:
+            return {
+                "status": "clarification",
+                "questions": clar.split("\n")
+            }
+
+        # Ejecutar la consulta (camino rápido o agente SQL)
+        if sql_task is not None:
+            resultado, sql = await sql_task
+        else:
+            resultado, sql = await answer_sql(
+                tenant_name, base_name, schema_text, tables, context_text, pregunta, clar, mode
+            )
+
+        # Generar explicación del resultado
+        explic = await explain(context_text, pregunta, schema_text, resultado)
+
+        # Guardar resultado y explicación en la conversación
+        await save_messages(
+            tenant_name, user_id,
+            ("assistant_query_result", resultado), ("assistant_explanation", explic),
+        )
+        remember_answer(tenant_name, base_name, pregunta, versions, sql, resultado, explic)
+
+        response = {
+            "status": "success",
+            "result": resultado,
+            "explicacion": explic
+        }
+        if sql:
+            # El resultado completo se descarga paginado desde /results
+            response["query_id"] = register_query(tenant_name, base_name, user_id, extract_sql(sql))
+        return response
+
+# ----------------------------------------
+# /query en streaming (server-sent events)
+# ----------------------------------------
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def _count_rows(output: str):
+    """Cantidad de filas en la salida de sql_db_query (lista de tuplas o resultado resumido)."""
+    summary = re.match(r"Filas: (\d+\+?)", output or "")
+    if summary:
+        return summary.group(1)
+    try:
+        rows = ast.literal_eval(output) if output else []
+        return len(rows) if isinstance(rows, list) else None
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+class AgentStepHandler(AsyncCallbackHandler):
+    """Publica en una cola cada paso del agente (herramienta, SQL y filas devueltas)."""
+
+    def __init__(self, events: asyncio.Queue):
+        self.events = events
+
+    async def on_agent_action(self, action, **kwargs):
+        await self.events.put(("agent_action", {"tool": action.tool, "input": action.tool_input}))
+
+    async def on_tool_end(self, output, **kwargs):
+        name = kwargs.get("name")
+        data = {"tool": name}
+        if name == "sql_db_query":
+            data["rows"] = _count_rows(str(output))
+        await self.events.put(("agent_observation", data))
+
+async def stream_explanation(context_text: str, pregunta: str, schema_text: str, resultado: str):
+    """
+    Genera la explicación token a token. El LLM corre en una tarea que llena una
+    cola: llm_slot se libera apenas termina la generación, no cuando el cliente
+    terminó de leer los tokens.
+    """
+    explicador_chain = explicador.get_chain()
+    chain = explicador_chain.prompt | explicador_chain.llm
+    tokens = asyncio.Queue()
+
+    async def generate():
+        try:
+            async with llm_slot():
+                async for chunk in chain.astream({
+                    "contexto": context_text,
+                    "pregunta": pregunta,
+                    "schema": schema_text,
+                    "resultado": resultado
+                }):
+                    if chunk.content:
+                        tokens.put_nowait(chunk.content)
+        finally:
+            tokens.put_nowait(None)
+
+    task = asyncio.create_task(generate())
+    try:
+        while True:
+            token = await tokens.get()
+            if token is None:
+                break
+            yield token
+        # Propaga los errores del LLM (p.ej. LLMBusyError)
+        await task
+    finally:
+        # El cliente se desconectó antes del final
+        task.cancel()
+
+async def stream_query(tenant_name: str, base_name: str, user_id: int, pregunta: str,
+                       mode: str = None):
+    """
+    Igual que run_query pero emite un evento SSE por etapa: clarificación,
+    pasos del agente, resultado y la explicación a medida que se genera.
+    """
+    mode = resolve_sql_mode(tenant_name, mode)
+    with trace_request("query_stream", tenant_name):
+        async for event in _stream_query(tenant_name, base_name, user_id, pregunta, mode):
+            yield event
+
+async def _stream_query(tenant_name: str, base_name: str, user_id: int, pregunta: str, mode: str):
+    async with tenant_slot(tenant_name):
+        try:
+            cached, versions = await check_answer_cache(tenant_name, base_name, user_id, pregunta)
+            await save_messages(tenant_name, user_id, ("user", pregunta))
+            if cached is not None:
+                await save_messages(
+                    tenant_name, user_id,
+                    ("assistant_query_result", cached.result), ("assistant_explanation", cached.explanation),
+                )
+                set_trace_status("cached")
+                yield sse_event("result", {"result": cached.result, "sql": cached.sql, "cached": True})
+                done = {
+                    "status": "success", "result": cached.result,
+                    "explicacion": cached.explanation, "cached": True,
+                }
+                if cached.sql:
+                    done["query_id"] = register_query(tenant_name, base_name, user_id, extract_sql(cached.sql))
+                yield sse_event("done", done)
+                return
+
+            schema_text, context_text, tables = await load_context(tenant_name, base_name, user_id, pregunta)
+
+            # Los pasos del agente se encolan; con especulación empiezan antes de la clarificación
+            events = asyncio.Queue()
+            callbacks = [AgentStepHandler(events)]
+            clar, agent_task = await clarify_with_speculation(
+                tenant_name, base_name, schema_text, tables, context_text, pregunta, mode, callbacks=callbacks
+            )
+            await save_messages(tenant_name, user_id, ("assistant_clarification", clar))
+            if clar != NO_CLARIFICATION:
+                set_trace_status("clarification")
+                yield sse_event("clarification", {"questions": clar.split("\n")})
+                return
+
+            # La consulta corre en una tarea y los pasos del agente se emiten mientras avanza
+            if agent_task is None:
+                agent_task = asyncio.create_task(answer_sql(
+                    tenant_name, base_name, schema_text, tables, context_text, pregunta, clar, mode,
+                    callbacks=callbacks,
+                ))
+            try:
+                yield sse_event("clarification", {"status": NO_CLARIFICATION})
+                while not agent_task.done() or not events.empty():
+                    getter = asyncio.create_task(events.get())
+                    done, _ = await asyncio.wait({getter, agent_task}, return_when=asyncio.FIRST_COMPLETED)
+                    if getter in done:
+                        event, data = getter.result()
+                        yield sse_event(event, data)
+                    else:
+                        getter.cancel()
+                resultado, sql = agent_task.result()
+            finally:
+                if not agent_task.done():
+                    # El cliente se desconectó
+                    agent_task.cancel()
+            yield sse_event("result", {"result": resultado, "sql": sql})
+
+            parts = []
+            with span("explain"):
+                async for token in stream_explanation(context_text, pregunta, schema_text, resultado):
+                    parts.append(token)
+                    yield sse_event("explanation_token", {"token": token})
+            explic = "".join(parts).strip()
+
+            await save_messages(
+                tenant_name, user_id,
+                ("assistant_query_result", resultado), ("assistant_explanation", explic),
+            )
+            remember_answer(tenant_name, base_name, pregunta, versions, sql, resultado, explic)
+            done = {"status": "success", "result": resultado, "explicacion": explic}
+            if sql:
+                done["query_id"] = register_query(tenant_name, base_name, user_id, extract_sql(sql))
+            yield sse_event("done", done)
+
+        except Exception as e:
+            print(f"Error en stream_query: {e}")
+            set_trace_status("error")
+            yield sse_event("error", {"detail": str(e)})
+
+# ----------------------------------------
+# /feedback
+# ----------------------------------------
+
+async def run_feedback(tenant_name: str, user_id: int, fb: str) -> dict:
+    """
+    Clasifica el feedback y, si la explicación no fue útil, reformula la consulta.
+    """
+    with trace_request("feedback", tenant_name):
+        response = await _run_feedback(tenant_name, user_id, fb)
+        set_trace_status(response["status"])
+        return response
+
+async def _run_feedback(tenant_name: str, user_id: int, fb: str) -> dict:
+    async with tenant_slot(tenant_name):
+        with span("classify"):
+            async with llm_slot():
+                utilidad = (await clasificador.get_chain().arun({"feedback": fb})).strip().lower()
+        await save_messages(tenant_name, user_id, ("user_feedback", fb))
+
+        if utilidad == "útil":
+            return {"status": "ok", "message": "¡Genial que haya servido!"}
+
+        with span("load_context"):
+            context = await run_in_threadpool(
+                get_context_window, tenant_name, user_id, context_budget(0, fb)
+            )
+        hist_str = "\n".join(f"{r}: {c}" for r, c in context)
+        with span("reformulate"):
+            async with llm_slot():
+                nueva = (await reformulador.get_chain().arun({"historial": hist_str, "nueva_aclaracion": fb})).strip()
+
+        await save_messages(tenant_name, user_id, ("assistant_reformulated_query", nueva))
+        return {"status": "reformulate", "new_query": nueva}
@@ -0,0 +1,230 @@
+# retention.py
+"""
+Retención de chat_messages: por tenant se aplica un TTL (ttl_days) y un máximo de
+filas (max_rows). Lo que sobra se mueve en lotes a un SQLite de archivo por
+tenant y mes (RETENTION_ARCHIVE_DIR/<tenant>/<AAAA-MM>.sqlite), se borra del
+admin DB y al final se libera espacio con VACUUM incremental.
+
+También purga de executed_queries los query_id que pasaron RESULT_REGISTRY_TTL
+(ya no se pueden paginar ni exportar, no se archivan).
+
+    python retention.py                 # todos los tenants
+    python retention.py --tenant acme --dry-run
+"""
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from sqlalchemy import or_, text
+
+from db import admin_engine, get_admin_session
+from models import ChatMessage, ExecutedQuery, Tenant
+from executor import registry_cutoff
+from memory import flush_messages, invalidate_buffers
+from config import RETENTION_POLICIES, RETENTION_ARCHIVE_DIR, RETENTION_BATCH, RETENTION_VACUUM_PAGES
+
+_ARCHIVE_COLUMNS = ("id", "tenant_id", "user_id", "role", "content", "timestamp", "token_count")
+
+
+def policy_for(tenant_name: str) -> Dict[str, Optional[int]]:
+    """Política del tenant; lo que no defina se toma de "*" (0 o ausente = sin límite)."""
+    policy = {"ttl_days": None, "max_rows": None}
+    for source in (RETENTION_POLICIES.get("*", {}), RETENTION_POLICIES.get(tenant_name, {})):
+        policy.update({k: v for k, v in source.items() if k in policy})
+    return {k: (v or None) for k, v in policy.items()}
+
+
+def _archive_path(tenant_name: str, timestamp: datetime.datetime) -> str:
+    safe = re.sub(r"[^\w.-]", "_", tenant_name)
+    month = timestamp.strftime("%Y-%m") if timestamp else "sin-fecha"
+    return os.path.join(RETENTION_ARCHIVE_DIR, safe, f"{month}.sqlite")
+
+
+def _write_archive(path: str, rows: List[tuple]):
+    """Agrega filas al archivo del mes. Es idempotente por id (si se corta a mitad se puede repetir)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_messages ("
+            "id INTEGER PRIMARY KEY, tenant_id INTEGER, user_id INTEGER, role TEXT, "
+            "content TEXT, timestamp TEXT, token_count INTEGER)"
+        )
+        conn.executemany(
+            f"INSERT OR IGNORE INTO chat_messages ({', '.join(_ARCHIVE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(*row[:5], row[5].isoformat(sep=" ") if row[5] else None, row[6]) for row in rows],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _cutoff_id(db, tenant_id: int, max_rows: Optional[int]) -> int:
+    """Id más alto a archivar por max_rows (0 si el tenant no lo supera)."""
+    if not max_rows:
+        return 0
+    row = (
+        db.query(ChatMessage.id)
+          .filter(ChatMessage.tenant_id == tenant_id)
+          .order_by(ChatMessage.id.desc())
+          .offset(max_rows)
+          .first()
+    )
+    return row[0] if row else 0
+
+
+def apply_tenant_retention(tenant_name: str, dry_run: bool = False) -> dict:
+    """Archiva y borra los mensajes del tenant que exceden su política."""
+    policy = policy_for(tenant_name)
+    report = {"policy": policy, "archived": 0, "files": []}
+    if not policy["ttl_days"] and not policy["max_rows"]:
+        return report
+
+    db = get_admin_session()
+    try:
+        tenant = db.query(Tenant).filter_by(name=tenant_name).first()
+        if tenant is None:
+            raise ValueError(f"No se encontró el tenant '{tenant_name}'")
+        conditions = []
+        if policy["ttl_days"]:
+            limit = datetime.datetime.utcnow() - datetime.timedelta(days=policy["ttl_days"])
+            conditions.append(ChatMessage.timestamp < limit)
+        cutoff = _cutoff_id(db, tenant.id, policy["max_rows"])
+        if cutoff:
+            conditions.append(ChatMessage.id <= cutoff)
+        if not conditions:
+            return report
+
+        candidates = db.query(ChatMessage).filter(ChatMessage.tenant_id == tenant.id, or_(*conditions))
+        if dry_run:
+            report["archived"] = candidates.count()
+            return report
+
+        files = set()
+        last_id = 0
+        while True:
+            batch = (
+                candidates.filter(ChatMessage.id > last_id)
+                          .order_by(ChatMessage.id)
+                          .limit(RETENTION_BATCH)
+                          .with_entities(*(getattr(ChatMessage, c) for c in _ARCHIVE_COLUMNS))
+                          .all()
+            )
+            if not batch:
+                break
+            by_file = defaultdict(list)
+            for row in batch:
+                by_file[_archive_path(tenant_name, row[5])].append(tuple(row))
+            # Primero se escribe el archivo y recién después se borra del admin DB
+            for path, rows in by_file.items():
+                _write_archive(path, rows)
+                files.add(path)
+            ids = [row[0] for row in batch]
+            db.query(ChatMessage).filter(ChatMessage.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            report["archived"] += len(ids)
+            last_id = ids[-1]
+        report["files"] = sorted(files)
+    finally:
+        db.close()
+
+    if report["archived"]:
+        # Los buffers en memoria pueden tener turnos que ya no están en la base
+        invalidate_buffers(tenant_name)
+    return report
+
+
+def incremental_vacuum() -> dict:
+    """
+    Devuelve al sistema el espacio liberado del admin DB (solo SQLite). La primera
+    vez pasa la base a auto_vacuum=INCREMENTAL, lo que requiere un VACUUM completo.
+    """
+    if admin_engine.dialect.name != "sqlite":
+        return {"skipped": admin_engine.dialect.name}
+    with admin_engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        mode = conn.execute(text("PRAGMA auto_vacuum")).scalar()
+        converted = False
+        if mode != 2:
+            conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+            conn.execute(text("VACUUM"))
+            converted = True
+        free_before = conn.execute(text("PRAGMA freelist_count")).scalar()
+        conn.execute(text(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})"))
+        free_after = conn.execute(text("PRAGMA freelist_count")).scalar()
+    return {"converted": converted, "pages_freed": free_before - free_after, "pages_left": free_after}
+
+
+def purge_executed_queries(dry_run: bool = False) -> int:
+    """Borra en lotes las consultas registradas que ya caducaron; devuelve cuántas."""
+    cutoff = registry_cutoff()
+    db = get_admin_session()
+    try:
+        expired = db.query(ExecutedQuery.id).filter(ExecutedQuery.created_at < cutoff)
+        if dry_run:
+            return expired.count()
+        purged = 0
+        while True:
+            ids = [query_id for (query_id,) in expired.limit(RETENTION_BATCH).all()]
+            if not ids:
+                return purged
+            db.query(ExecutedQuery).filter(ExecutedQuery.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            purged += len(ids)
+    finally:
+        db.close()
+
+
+def run_retention(tenant_name: str = None, dry_run: bool = False) -> dict:
+    """Aplica la retención a un tenant (o a todos) y compacta el admin DB."""
+    # Lo encolado por el writer también cuenta para max_rows
+    flush_messages()
+    if tenant_name:
+        names = [tenant_name]
+    else:
+        db = get_admin_session()
+        try:
+            names = [name for (name,) in db.query(Tenant.name).order_by(Tenant.name).all()]
+        finally:
+            db.close()
+
+    report = {"tenants": {}}
+    for name in names:
+        try:
+            report["tenants"][name] = apply_tenant_retention(name, dry_run)
+        except Exception as e:
+            print(f"Error aplicando retención a {name}: {e}")
+            report["tenants"][name] = {"error": str(e)}
+    try:
+        report["executed_queries"] = purge_executed_queries(dry_run)
+    except Exception as e:
+        print(f"Error purgando executed_queries: {e}")
+        report["executed_queries"] = {"error": str(e)}
+    purged = report["executed_queries"] if isinstance(report["executed_queries"], int) else 0
+    if not dry_run and (purged or any(r.get("archived") for r in report["tenants"].values())):
+        report["vacuum"] = incremental_vacuum()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archiva mensajes viejos según la política de retención")
+    parser.add_argument("--tenant", help="solo este tenant")
+    parser.add_argument("--dry-run", action="store_true", help="solo contar lo que se archivaría")
+    args = parser.parse_args()
+    report = run_retention(args.tenant, args.dry_run)
+    for name, result in report["tenants"].items():
+        if "error" in result:
+            print(f"{name}: error {result['error']}")
+        else:
+            print(f"{name}: {result['archived']} mensajes {'a archivar' if args.dry_run else 'archivados'}")
+    print(f"executed_queries: {report['executed_queries']} {'a purgar' if args.dry_run else 'purgadas'}")
+    if "vacuum" in report:
+        print(f"VACUUM: {report['vacuum']}")
+
+
+if __name__ == "__main__":
+    main()
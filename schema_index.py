@@ -0,0 +1,182 @@
+# schema_index.py
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from cache import LRUCache
+from db import get_compiled_schema, get_tenant_engine
+from executor import get_catalog
+from config import (
+    TENANT_ENGINE_MAX, SCHEMA_PRUNING_ENABLED, SCHEMA_TOP_K, SCHEMA_MAX_TABLES, SCHEMA_PRUNE_MIN_TABLES,
+)
+
+# Parámetros de BM25
+_K1 = 1.5
+_B = 0.75
+# El nombre de la tabla pesa más que su descripción
+_NAME_WEIGHT = 3
+
+_STOPWORDS = set("""
+a al algun alguna como con cual cuale cuant cuanta cuanto da de del donde e el ella ello en entre
+era es esa ese esta este esto fue ha hay la lo mas me mi muy no o para pero por que quien se sea
+ser si sin sobre su tambien te tiene todo toda un una uno y ya cada hace listar lista mostrar dame
+the of and or to in for on with by is are what which who how many much all each from
+""".split())
+
+
+def _strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> List[str]:
+    """Palabras en minúscula y sin acentos; separa camelCase y snake_case y quita plurales simples."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text or "")
+    words = re.findall(r"[a-z0-9]+", _strip_accents(text).lower())
+    tokens = []
+    for word in words:
+        if len(word) > 4 and word.endswith("es"):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        if word not in _STOPWORDS:
+            tokens.append(word)
+    return tokens
+
+
+class _TableDoc:
+    __slots__ = ("source", "terms", "length")
+
+    def __init__(self, source: str, terms: Counter):
+        self.source = source    # texto a partir del que se indexó (para reindexar solo lo que cambió)
+        self.terms = terms
+        self.length = sum(terms.values())
+
+
+class SchemaIndex:
+    """
+    Índice BM25 de las tablas de una base: nombre, descripción semántica y columnas.
+    Se actualiza por tabla: solo se re-tokenizan las tablas cuyo texto cambió.
+    update() (bajo lock) arma un snapshot nuevo y lo publica de una vez, así
+    search() lee sin lock un (docs, df, avgdl) que nunca se modifica.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.snapshot: Tuple[Dict[str, _TableDoc], Counter, float] = ({}, Counter(), 0.0)
+        self.lock = threading.Lock()
+
+    def update(self, version: str, sources: Dict[str, Tuple[str, str]]):
+        """sources: tabla -> (nombre, texto). Reindexa solo las tablas nuevas o modificadas."""
+        previous = self.snapshot[0]
+        docs = {}
+        for table, (name, text) in sources.items():
+            source = f"{name}\n{text}"
+            doc = previous.get(table)
+            if doc is None or doc.source != source:
+                terms = Counter(tokenize(text))
+                for token in tokenize(name):
+                    terms[token] += _NAME_WEIGHT
+                doc = _TableDoc(source, terms)
+                _index_stats["tables_indexed"] += 1
+            docs[table] = doc
+        df = Counter()
+        for doc in docs.values():
+            df.update(doc.terms.keys())
+        avgdl = sum(d.length for d in docs.values()) / len(docs) if docs else 0.0
+        self.snapshot = (docs, df, avgdl)
+        self.version = version
+
+    def search(self, question: str) -> List[Tuple[str, float]]:
+        """Tablas con puntaje > 0, de la más a la menos relevante."""
+        docs, df, avgdl = self.snapshot
+        query = set(tokenize(question))
+        n = len(docs)
+        scores = []
+        for table, doc in docs.items():
+            score = 0.0
+            for term in query:
+                tf = doc.terms.get(term)
+                if not tf:
+                    continue
+                idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+                score += idf * tf * (_K1 + 1) / (tf + _K1 * (1 - _B + _B * doc.length / (avgdl or 1)))
+            if score > 0:
+                scores.append((table, score))
+        scores.sort(key=lambda item: -item[1])
+        return scores
+
+
+_index_stats = Counter()
+
+# (tenant, base) -> SchemaIndex. Un cambio de esquema no descarta el índice: la versión
+# (esquema semántico + DDL) deja de coincidir y se reindexan solo las tablas que cambiaron.
+_indexes = LRUCache(maxsize=TENANT_ENGINE_MAX * 4)
+
+
+def _index_sources(compiled, catalog) -> Dict[str, Tuple[str, str]]:
+    sources = {}
+    for table, columns in catalog.tables.items():
+        description = compiled.tables.get(table, "")
+        sources[table] = (table, f"{description}\n{' '.join(columns)}")
+    # Tablas descritas en el esquema semántico que no aparecen en la base
+    for table, description in compiled.tables.items():
+        sources.setdefault(table, (table, description))
+    return sources
+
+
+def get_schema_index(tenant_name: str, base_name: str) -> SchemaIndex:
+    compiled = get_compiled_schema(tenant_name, base_name)
+    catalog = get_catalog(get_tenant_engine(tenant_name, base_name))
+    index = _indexes.get_or_create((tenant_name, base_name), SchemaIndex)
+    version = (compiled.version, catalog.ddl)
+    if index.version != version:
+        with index.lock:
+            if index.version != version:
+                index.update(version, _index_sources(compiled, catalog))
+    return index
+
+
+def select_tables(tenant_name: str, base_name: str, question: str) -> List[str]:
+    """
+    Tablas relevantes para la pregunta: las SCHEMA_TOP_K mejores según BM25 más sus
+    vecinas por foreign key (en ambos sentidos), hasta SCHEMA_MAX_TABLES.
+    Devuelve todas las tablas si la base es chica o si la pregunta no matchea nada.
+    """
+    compiled = get_compiled_schema(tenant_name, base_name)
+    catalog = get_catalog(get_tenant_engine(tenant_name, base_name))
+    all_tables = list(dict.fromkeys([*catalog.tables, *compiled.tables]))
+    if not SCHEMA_PRUNING_ENABLED or len(all_tables) < SCHEMA_PRUNE_MIN_TABLES:
+        return all_tables
+
+    ranked = get_schema_index(tenant_name, base_name).search(question)
+    if not ranked:
+        _index_stats["fallback_full"] += 1
+        return all_tables
+    _index_stats["pruned"] += 1
+
+    selected = [table for table, _ in ranked[:SCHEMA_TOP_K]]
+    neighbors = []
+    for table in selected:
+        neighbors.extend(catalog.references.get(table, []))
+        neighbors.extend(t for t, refs in catalog.references.items() if table in refs)
+    # Vecinas ordenadas por su propio puntaje, las que no matchean al final
+    score = dict(ranked)
+    neighbors = sorted(dict.fromkeys(n for n in neighbors if n not in selected),
+                       key=lambda t: -score.get(t, 0.0))
+    return (selected + neighbors)[:max(SCHEMA_MAX_TABLES, len(selected))]
+
+
+def pruned_schema_text(tenant_name: str, base_name: str, tables: List[str]) -> str:
+    """Mismo formato que CompiledSchema.text pero solo con las tablas indicadas."""
+    compiled = get_compiled_schema(tenant_name, base_name)
+    subset = {t: compiled.tables[t] for t in tables if t in compiled.tables}
+    if len(subset) == len(compiled.tables):
+        return compiled.text
+    return str(subset) if subset else compiled.text
+
+
+def schema_index_stats() -> dict:
+    return {**_indexes.stats(), **_index_stats}
@@ -0,0 +1,91 @@
+# startup.py
+import importlib
+import pkgutil
+import sys
+import threading
+import time
+
+# Momento en que se importó este módulo (app.py lo importa primero)
+PROCESS_T0 = time.perf_counter()
+
+_report = {"imports": {}, "init": {}, "marks": {}, "warmup": None}
+_lock = threading.Lock()
+
+# Dependencias pesadas que el request path importa de forma diferida
+HEAVY_IMPORTS = [
+    "langchain_google_genai",
+    "langchain.chains",
+    "langchain_community.utilities",
+    "langchain_community.agent_toolkits",
+    "langchain.agents",
+    "tiktoken",
+]
+
+
+def mark(name: str):
+    """Registra cuántos segundos pasaron desde el arranque hasta este punto."""
+    with _lock:
+        _report["marks"][name] = round(time.perf_counter() - PROCESS_T0, 4)
+
+
+def timed_import(module_name: str) -> float:
+    """Importa un módulo midiendo su costo (0 si ya estaba importado)."""
+    if module_name in sys.modules:
+        elapsed = 0.0
+    else:
+        t = time.perf_counter()
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            print(f"No se pudo importar {module_name}: {e}")
+        elapsed = time.perf_counter() - t
+    with _lock:
+        _report["imports"].setdefault(module_name, round(elapsed, 4))
+    return elapsed
+
+
+def timed_init(name: str, fn):
+    t = time.perf_counter()
+    try:
+        return fn()
+    except Exception as e:
+        print(f"Error inicializando {name}: {e}")
+    finally:
+        with _lock:
+            _report["init"][name] = round(time.perf_counter() - t, 4)
+
+
+def warmup():
+    """Importa las dependencias diferidas y construye las chains y el cliente LLM."""
+    import chains
+    from llm_provider import get_llm
+    from tokens import get_encoder
+
+    t = time.perf_counter()
+    for module_name in HEAVY_IMPORTS:
+        timed_import(module_name)
+    timed_init("llm_client", get_llm)
+    timed_init("tokenizer", get_encoder)
+    # Todas las chains del paquete: una chain nueva se precalienta sin tocar esta lista
+    for module_info in pkgutil.iter_modules(chains.__path__):
+        chain_module = importlib.import_module(f"chains.{module_info.name}")
+        if hasattr(chain_module, "get_chain"):
+            timed_init(chain_module.__name__, chain_module.get_chain)
+    with _lock:
+        _report["warmup"] = round(time.perf_counter() - t, 4)
+    mark("warmup_done")
+
+
+def warmup_in_background():
+    """Precalienta sin demorar el arranque: el worker ya acepta tráfico."""
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+
+def startup_report() -> dict:
+    with _lock:
+        return {
+            "imports": dict(_report["imports"]),
+            "init": dict(_report["init"]),
+            "marks": dict(_report["marks"]),
+            "warmup": _report["warmup"],
+        }
@@ -0,0 +1,36 @@
+# tokens.py
+from functools import lru_cache
+from config import TOKENIZER_ENCODING, MAX_TOKENS_CONTEXT, PROMPT_RESERVE_TOKENS
+
+
+@lru_cache(maxsize=1)
+def get_encoder():
+    """
+    Devuelve el encoder de tiktoken (se construye una sola vez por proceso).
+    Si tiktoken no está disponible devuelve None y se usa una estimación.
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        print(f"No se pudo cargar el tokenizer '{TOKENIZER_ENCODING}', se estima por palabras: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoder = get_encoder()
+    if encoder is None:
+        # Aproximación: ~4 caracteres por token, nunca menos que las palabras
+        return max(len(text.split()), len(text) // 4)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def context_budget(schema_tokens: int, question: str, max_tokens: int = MAX_TOKENS_CONTEXT) -> int:
+    """
+    Tokens disponibles para el contexto de conversación, una vez descontados
+    el esquema, la pregunta y lo reservado para instrucciones y respuesta.
+    """
+    budget = max_tokens - schema_tokens - count_tokens(question) - PROMPT_RESERVE_TOKENS
+    return max(budget, 0)